@@ -0,0 +1,235 @@
+"""Benchmarks for the map and tasklist code, run on synthetic maps, tasklists and chat so results can be compared between commits.
+
+Run with "python benchmark.py --output results.json", then after a change run it again with "--compare results.json"
+to see how much each benchmark got faster or slower. The same seed always generates the same data.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import pokemap
+
+NAME_WORDS = ['Old', 'North', 'South', 'East', 'West', 'Grand', 'Little', 'Upper', 'Lower', 'Saint', 'Memorial', 'Riverside',
+              'Maple', 'Oak', 'Cedar', 'Pine', 'Elm', 'Willow', 'Birch', 'Cherry', 'Lincoln', 'Washington', 'Franklin', 'Jefferson',
+              'Harbor', 'Lake', 'Hill', 'Valley', 'Meadow', 'Garden', 'Market', 'Station', 'Union', 'Liberty', 'Heritage', 'Pioneer']
+NAME_KINDS = ['Park', 'Library', 'Church', 'Fountain', 'Mural', 'Statue', 'Plaque', 'Bridge', 'Gazebo', 'Playground', 'Trailhead',
+              'Post Office', 'Fire Station', 'Town Hall', 'Clock Tower', 'Bench', 'Sign', 'Monument', 'Chapel', 'Pavilion']
+QUESTS = ['Catch 10 Pokemon', 'Make 3 Great Throws', 'Hatch an Egg', 'Win a Raid', 'Spin 10 Pokestops', 'Evolve a Pokemon',
+          'Power Up Pokemon 5 Times', 'Trade a Pokemon', 'Send 3 Gifts', 'Make 5 Nice Curveball Throws', 'Battle in a Gym']
+CHAT = ['anyone going to the raid later?', 'lol', 'nice catch!', 'is the gym still blue', 'omw', 'thanks everyone',
+        'what time does the event start', 'I need 2 more for the raid at the park', 'does anyone have a spare lucky egg',
+        'good morning', 'that was close', 'finally got my shiny', 'who wants to trade', 'brb']
+BOUNDS = [42.40, -76.55, 42.50, -76.45]   # lat1, long1, lat2, long2 of the synthetic maps
+QUERIES = 1000   # Lookups timed per benchmark
+FUZZY_QUERIES = 200   # Fuzzy lookups timed per map size, as each one scores many stops
+SIZES = [1000, 10000, 100000]
+
+
+def stop_names(count, rng):
+    """Return count distinct stop names made from common place name words."""
+    names = []
+    seen = set()
+    while len(names) < count:
+        name = rng.choice(NAME_WORDS) + ' ' + rng.choice(NAME_KINDS)
+        if rng.random() < 0.3:
+            name = rng.choice(NAME_WORDS) + ' ' + name
+        if name in seen:
+            name += ' ' + str(len(names))
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def synthetic_map(size, rng, nickname_share=0.2):
+    """Return a map with size stops spread over BOUNDS, with a nickname on roughly nickname_share of them."""
+    taskmap = pokemap.new()
+    taskmap._data['bounds'] = list(BOUNDS)
+    day = int(taskmap.now().strftime("%j"))
+    for i, name in enumerate(stop_names(size, rng)):
+        long = rng.uniform(BOUNDS[1], BOUNDS[3])
+        lat = rng.uniform(BOUNDS[0], BOUNDS[2])
+        stop = taskmap._add_new_stop([long, lat], name, day)
+        if rng.random() < nickname_share:
+            stop.add_nickname('Stop ' + str(i))
+    return taskmap
+
+
+def synthetic_tasklist(size, rng, pokemon):
+    """Return a tasklist with size tasks, rewarding pokemon or items, some with nicknames."""
+    tasklist = pokemap.Tasklist()
+    for i in range(size):
+        if i < len(pokemon):
+            reward = pokemon[i]
+        else:
+            reward = rng.choice(['Rare Candy', 'Silver Pinap', 'Stardust', rng.choice(pokemon) + ' or ' + rng.choice(pokemon)]) + ' ' + str(i)
+        task = pokemap.Task(reward, rng.choice(QUESTS) + ' ' + str(i), rng.random() < 0.1)
+        if rng.random() < 0.2:
+            task.add_nickname(reward[:4] + str(i))
+        tasklist.add_task(task)
+    return tasklist
+
+
+def misspell(name, rng):
+    """Return a name with one of its letters dropped or swapped with the next."""
+    i = rng.randrange(len(name) - 1)
+    if rng.random() < 0.5:
+        return name[:i] + name[i + 1:]
+    return name[:i] + name[i + 1] + name[i] + name[i + 2:]
+
+
+def chat_corpus(taskmap, tasklist, size, rng):
+    """Return size messages like those in a report channel: stop names, task names and ordinary chat."""
+    stops = list(taskmap)
+    messages = []
+    for i in range(size):
+        kind = rng.random()
+        if kind < 0.4:
+            messages.append(rng.choice(CHAT))
+        elif kind < 0.6:
+            messages.append(rng.choice(stops).properties['Stop Name'])
+        elif kind < 0.7:
+            messages.append(misspell(rng.choice(stops).properties['Stop Name'], rng))
+        elif kind < 0.9:
+            messages.append(rng.choice(tasklist.tasks).reward)
+        else:
+            messages.append(rng.choice(stops).properties['Stop Name'] + ', ' + rng.choice(tasklist.tasks).reward)
+    return messages
+
+
+def timed(func, inputs):
+    """Call func on each input, returning the call count and the mean, median and 95th percentile in microseconds.
+
+    Exceptions from the map and tasklist, such as a stop not being found, are part of the normal path and are ignored.
+    """
+    seconds = []
+    for value in inputs:
+        start = time.perf_counter()
+        try:
+            func(value)
+        except pokemap.PokemapException:
+            pass
+        seconds.append(time.perf_counter() - start)
+    return summarize(seconds)
+
+
+def summarize(seconds):
+    """Summarize a list of durations."""
+    seconds = sorted(seconds)
+    return {'calls': len(seconds),
+            'mean_us': round(1e6 * sum(seconds) / len(seconds), 3),
+            'median_us': round(1e6 * seconds[len(seconds) // 2], 3),
+            'p95_us': round(1e6 * seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))], 3)}
+
+
+def run_size(size, seed, repeat, directory, pokemon_names):
+    """Run every benchmark on a map of one size, returning the results keyed by benchmark name."""
+    rng = random.Random(seed + size)
+    results = {}
+    start = time.perf_counter()
+    taskmap = synthetic_map(size, rng)
+    tasklist = synthetic_tasklist(min(size, 5000), rng, pokemon_names.names)
+    results['build_map'] = summarize([time.perf_counter() - start])
+    stops = list(taskmap)
+    names = [rng.choice(stops).properties['Stop Name'] for i in range(QUERIES)]
+    nicknames = [nickname for stop in stops for nickname in stop.properties['Nicknames']]
+    results['find_stop_exact'] = timed(taskmap.find_stop, names)
+    if nicknames:
+        results['find_stop_nickname'] = timed(taskmap.find_stop, [rng.choice(nicknames) for i in range(QUERIES)])
+    results['find_stop_fuzzy'] = timed(taskmap.find_stop, [misspell(rng.choice(names), rng) for i in range(FUZZY_QUERIES)])
+    results['find_stop_missing'] = timed(taskmap.find_stop, [rng.choice(CHAT) for i in range(FUZZY_QUERIES)])
+    corpus = chat_corpus(taskmap, tasklist, QUERIES, rng)
+    results['could_be_stop_chat'] = timed(taskmap.could_be_stop, corpus)
+    results['find_stop_chat'] = timed(taskmap.find_stop, [message for message in corpus if taskmap.could_be_stop(message)][:FUZZY_QUERIES])
+    rewards = [rng.choice(tasklist.tasks).reward for i in range(QUERIES)]
+    results['find_task'] = timed(tasklist.find_task, rewards)
+    results['find_task_custom_quest'] = timed(tasklist.find_task, [reward + ':' + rng.choice(QUESTS) for reward in rewards])
+    pokemon = [rng.choice(pokemon_names.names) for i in range(QUERIES)]
+    results['match_pokemon_exact'] = timed(pokemon_names.match, pokemon)
+    results['match_pokemon_fuzzy'] = timed(pokemon_names.match, [misspell(name, rng) for name in pokemon])
+    results['match_pokemon_chat'] = timed(pokemon_names.match, [word for message in corpus for word in message.split()][:QUERIES])
+    for stop in rng.sample(stops, min(len(stops), 1000)):
+        stop.set_task(rng.choice(tasklist.tasks))
+    yesterday = (taskmap.now() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+    def reset_old(value):
+        """Make the map a day old then reset it."""
+        taskmap._data['day'] = yesterday
+        taskmap.reset_old()
+    results['reset_old_rollover'] = timed(reset_old, range(repeat))
+    results['reset_old_same_day'] = timed(lambda value: taskmap.reset_old(), range(QUERIES))
+    results['reset_all'] = timed(lambda value: taskmap.reset_all(), range(repeat))
+    filename = os.path.join(directory, str(size) + '.json')
+    results['save'] = timed(lambda value: taskmap.save(filename), range(repeat))
+    results['load'] = timed(lambda value: pokemap.load(filename), range(repeat))
+    tasklist_file = os.path.join(directory, str(size) + '.jsonl')
+    results['tasklist_save'] = timed(lambda value: tasklist.save(tasklist_file), range(repeat))
+    results['tasklist_load'] = timed(lambda value: pokemap.read_tasklist(tasklist_file), range(repeat))
+    results['remove_stop'] = timed(taskmap.remove_stop, rng.sample(stops, min(len(stops), 100)))
+    return results
+
+
+def git_commit():
+    """Return the commit being benchmarked, or None outside a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(sizes, seed=0, repeat=3):
+    """Run the benchmarks for each map size, returning the results with a description of what was run."""
+    pokemon_names = pokemap.PokemonNames(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pokemon.txt'))
+    directory = tempfile.mkdtemp()
+    try:
+        results = {}
+        for size in sizes:
+            print('Benchmarking ' + str(size) + ' stops')
+            results[str(size)] = run_size(size, seed, repeat, directory, pokemon_names)
+    finally:
+        shutil.rmtree(directory)
+    return {'commit': git_commit(), 'python': platform.python_version(), 'date': datetime.datetime.now().isoformat(),
+            'seed': seed, 'repeat': repeat, 'results': results}
+
+
+def compare(old, new):
+    """Return lines comparing the mean time of each benchmark in two sets of results."""
+    lines = []
+    for size, benchmarks in sorted(new['results'].items(), key=lambda item: int(item[0])):
+        old_benchmarks = old['results'].get(size, {})
+        for name, result in sorted(benchmarks.items()):
+            line = size.rjust(7) + ' ' + name.ljust(24) + format(result['mean_us'], '14.1f') + 'us'
+            if name in old_benchmarks and old_benchmarks[name]['mean_us'] > 0:
+                line += format(old_benchmarks[name]['mean_us'], '14.1f') + 'us' + format(result['mean_us'] / old_benchmarks[name]['mean_us'], '8.2f') + 'x'
+            lines.append(line)
+    return lines
+
+
+def main():
+    """Run the benchmarks from the command line."""
+    parser = argparse.ArgumentParser(description='Benchmark the map and tasklist code on synthetic data.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES, help='numbers of stops in the maps to benchmark')
+    parser.add_argument('--seed', type=int, default=0, help='seed for generating the maps, tasklists and chat')
+    parser.add_argument('--repeat', type=int, default=3, help='times to run the slow benchmarks, such as saving a map')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--compare', help='earlier results to compare against, ratios above 1 are slower')
+    args = parser.parse_args()
+    results = run(args.sizes, args.seed, args.repeat)
+    old = {'results': {}}
+    if args.compare is not None:
+        with open(args.compare) as file:
+            old = json.load(file)
+    print('\n'.join(compare(old, results)))
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
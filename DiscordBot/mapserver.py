@@ -0,0 +1,220 @@
+"""Small HTTP server, run inside the bot, that serves maps along with the changes made to them since a version."""
+import asyncio
+import json
+import aiohttp
+from aiohttp import web
+import metrics
+import pokemap
+
+SUBSCRIBER_QUEUE = 100   # Changes queued for a live subscriber before it is disconnected to catch up when it reconnects
+KEEPALIVE = 15   # Seconds between comments sent to idle live subscribers, so proxies keep the connection open
+
+
+class MapServer():
+    """Serve published maps from memory, so clients can poll for changes instead of downloading whole maps.
+
+    GET /maps/<map_id> returns the published map with its version, and an ETag so unchanged maps are answered with
+    304 Not Modified. GET /maps/<map_id>?since=<version> returns just the stop changes made after that version, or
+    410 Gone if they are too old to still be kept, in which case the client should fetch the whole map again.
+    GET /maps/<map_id>/events is a Server-Sent Events stream of the stop changes as they are made, starting after the
+    version in the since parameter or the Last-Event-ID header.
+    GET /metrics returns the bot's counters and latency histograms in the Prometheus text format.
+    Maps are found by calling lookup with the map id, which should return the map or None.
+    """
+
+    def __init__(self, lookup, host='0.0.0.0', port=8080):
+        """Set up the routes, without starting the server yet."""
+        self._lookup = lookup
+        self.host = host
+        self.port = port
+        self._encoded = {}
+        self._channels = {}
+        self._server = None
+        self._handler = None
+        self.app = web.Application()
+        self.app.router.add_route('GET', '/maps/{map_id}', self.get_map)
+        self.app.router.add_route('GET', '/maps/{map_id}/events', self.get_events)
+        self.app.router.add_route('GET', '/metrics', self.get_metrics)
+
+    async def start(self, loop):
+        """Start serving on loop."""
+        self._handler = self.app.make_handler()
+        self._server = await loop.create_server(self._handler, self.host, self.port)
+
+    async def stop(self):
+        """Stop serving."""
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def get_map(self, request):
+        """Answer a request for a whole map or the changes to it."""
+        map_id = request.match_info['map_id']
+        taskmap = self._lookup(map_id)
+        if taskmap is None:
+            return _response(404, {'error': 'No map with this id'})
+        since = _query(request).get('since')
+        if since is not None:
+            try:
+                changes = taskmap.changes_since(int(since))
+            except ValueError:
+                return _response(400, {'error': 'since must be a map version'})
+            if changes is None:
+                return _response(410, {'error': 'Changes since this version are no longer kept', 'version': taskmap.version})
+            return _response(200, {'version': taskmap.version, 'changes': changes})
+        etag = '"' + str(taskmap.version) + '"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers=_headers(etag))
+        return web.Response(status=200, body=self._encode(map_id, taskmap), headers=_headers(etag))
+
+    async def get_events(self, request):
+        """Stream the changes to a map to a client as they are made.
+
+        Each subscriber has a queue of changes waiting to be sent. A subscriber that falls too far behind is
+        disconnected, and when its browser reconnects it is sent the changes since the last one it got, or told to
+        reload the map if they are no longer kept. Subscribers are also told to reload after bulk edits to the map.
+        """
+        map_id = request.match_info['map_id']
+        taskmap = self._lookup(map_id)
+        if taskmap is None:
+            return _response(404, {'error': 'No map with this id'})
+        since = request.headers.get('Last-Event-ID', _query(request).get('since'))
+        channel = self._channels.get(map_id)
+        if channel is None or channel.taskmap is not taskmap:
+            if channel is not None:
+                channel.close()
+            channel = self._channels[map_id] = _Channel(taskmap)
+        queue = asyncio.Queue(SUBSCRIBER_QUEUE)
+        channel.subscribers.add(queue)
+        sent = taskmap.version
+        response = web.StreamResponse(headers=_headers())
+        response.headers['Content-Type'] = 'text/event-stream'
+        try:
+            await response.prepare(request)
+            try:
+                backlog = taskmap.changes_since(int(since)) if since is not None else []
+            except ValueError:
+                backlog = None
+            if backlog is None:
+                await _send(response, 'event: reload\ndata: {}\n\n')
+                return response
+            if since is not None:
+                sent = int(since)
+            await _send(response, 'retry: 2000\n\n')
+            for change in backlog:
+                await _send(response, _event(change))
+                sent = change['version']
+            while True:
+                try:
+                    change = await asyncio.wait_for(queue.get(), KEEPALIVE)
+                except asyncio.TimeoutError:
+                    await _send(response, ': keepalive\n\n')
+                    continue
+                if change is None:  # Fell too far behind, or the map was unloaded
+                    break
+                if change['op'] == 'reload':
+                    await _send(response, 'event: reload\ndata: {}\n\n')
+                    break
+                if change['version'] > sent:
+                    await _send(response, _event(change))
+                    sent = change['version']
+        finally:
+            channel.subscribers.discard(queue)
+            if not channel.subscribers and self._channels.get(map_id) is channel:
+                channel.close()
+                del self._channels[map_id]
+        return response
+
+    async def get_metrics(self, request):
+        """Answer a scrape of the metrics."""
+        return web.Response(status=200, body=metrics.registry.render().encode('utf-8'),
+                            headers={'Content-Type': 'text/plain; version=0.0.4', 'Cache-Control': 'no-cache'})
+
+    def _encode(self, map_id, taskmap):
+        """Return the published map as JSON bytes, encoding it again only if it has changed."""
+        version, encoded = self._encoded.get(map_id, (None, None))
+        if version != taskmap.version:
+            published = pokemap.publish_data(taskmap._data)
+            published['version'] = taskmap.version
+            encoded = json.dumps(published, separators=(',', ':')).encode('utf-8')
+            self._encoded[map_id] = (taskmap.version, encoded)
+        return encoded
+
+
+class _Channel():
+    """Fan the changes to one map out to the queues of its live subscribers."""
+
+    def __init__(self, taskmap):
+        """Start listening to a map."""
+        self.taskmap = taskmap
+        self.subscribers = set()
+        taskmap.add_listener(self.publish)
+
+    def publish(self, change):
+        """Queue a change for every subscriber, replacing the queue of any that are full with a disconnect.
+
+        A change of None, sent when the map is unloaded, disconnects every subscriber, so their browsers reconnect to
+        the map once it is loaded again.
+        """
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait(change)
+            except asyncio.QueueFull:
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def close(self):
+        """Stop listening to the map, so it can be unloaded."""
+        self.taskmap.remove_listener(self.publish)
+
+
+def _event(change):
+    """Return a change formatted as a server-sent event."""
+    return 'id: ' + str(change['version']) + '\nevent: change\ndata: ' + json.dumps(change, separators=(',', ':')) + '\n\n'
+
+
+async def _send(response, text):
+    """Write to a streamed response and wait until it has been sent, on both old and new versions of aiohttp."""
+    result = response.write(text.encode('utf-8'))
+    if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+        await result
+    else:
+        await response.drain()
+
+
+def _query(request):
+    """Return the query parameters of a request, which aiohttp 1.0 calls GET and later versions call query."""
+    query = getattr(request, 'GET', None)
+    if query is None:
+        query = request.query
+    return query
+
+
+def _headers(etag=None):
+    """Return the headers sent with every response."""
+    headers = {'Content-Type': 'application/json', 'Cache-Control': 'no-cache', 'Access-Control-Allow-Origin': '*'}
+    if etag is not None:
+        headers['ETag'] = etag
+    return headers
+
+
+def _response(status, data):
+    """Return a JSON response."""
+    return web.Response(status=status, body=json.dumps(data, separators=(',', ':')).encode('utf-8'), headers=_headers())
+
+
+async def follow(url):
+    """Print the changes streamed from a map's events url, to check the map server from the command line."""
+    async with aiohttp.ClientSession() as session:
+        async with session.get(url) as response:
+            async for line in response.content:
+                line = line.decode('utf-8').strip()
+                if line.startswith('data: '):
+                    print(line[len('data: '):])
+
+
+if __name__ == '__main__':
+    import sys
+    asyncio.get_event_loop().run_until_complete(follow(sys.argv[1]))
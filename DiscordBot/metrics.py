@@ -0,0 +1,131 @@
+"""Counters and latency histograms for the bot's hot paths, with output in the Prometheus text format."""
+import bisect
+import contextlib
+import os
+import time
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)   # Upper bounds in seconds
+
+
+class Histogram:
+    """Counts of observations falling in each of a set of buckets, along with their total."""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        """Initialize an empty histogram."""
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        """Add an observation."""
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate a quantile from the buckets, as the upper bound of the bucket it falls in."""
+        target = q * self.count
+        running = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            running += count
+            if running >= target:
+                return bound
+        return float('inf')
+
+
+class Metrics:
+    """Registry of counters and histograms, each identified by a name and a set of labels.
+
+    Labels with a value of None are left out, so code that is sometimes called without a guild can pass guild=None.
+    """
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        """Add to a counter."""
+        key = (name, _label_key(labels))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """Add an observation to a histogram."""
+        key = (name, _label_key(labels))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name, **labels):
+        """Time the body of a with statement into a histogram, whether or not it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def clear(self):
+        """Forget every counter and histogram."""
+        self.counters = {}
+        self.histograms = {}
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for name in sorted({name for name, labels in self.counters}):
+            lines.append('# TYPE ' + name + ' counter')
+            for (counter_name, labels), value in sorted(self.counters.items()):
+                if counter_name == name:
+                    lines.append(name + _format_labels(labels) + ' ' + str(value))
+        for name in sorted({name for name, labels in self.histograms}):
+            lines.append('# TYPE ' + name + ' histogram')
+            for (histogram_name, labels), histogram in sorted(self.histograms.items(), key=lambda item: item[0]):
+                if histogram_name != name:
+                    continue
+                running = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                    running += count
+                    lines.append(name + '_bucket' + _format_labels(labels + (('le', str(bound)),)) + ' ' + str(running))
+                lines.append(name + '_sum' + _format_labels(labels) + ' ' + repr(histogram.total))
+                lines.append(name + '_count' + _format_labels(labels) + ' ' + str(histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """Write the metrics to a file in the Prometheus text format, replacing it in one step."""
+        temp_name = filename + '.tmp'
+        with open(temp_name, 'w') as file:
+            file.write(self.render())
+        os.replace(temp_name, filename)
+
+    def summary(self, limit=10, **labels):
+        """Return lines describing the histograms with the most total time, optionally only those with some labels."""
+        wanted = set(_label_key(labels))
+        rows = [(histogram.total, name, labels, histogram) for (name, labels), histogram in self.histograms.items() if wanted <= set(labels)]
+        rows.sort(key=lambda row: row[0], reverse=True)
+        lines = []
+        for total, name, labels, histogram in rows[:limit]:
+            lines.append(name + _format_labels(labels) + ': ' + str(histogram.count) + ' calls, ' + format(total, '.3f') + 's total, ' +
+                         format(1000 * total / histogram.count, '.2f') + 'ms mean, p95 under ' + format(1000 * histogram.quantile(0.95), 'g') + 'ms')
+        return lines
+
+
+def _label_key(labels):
+    """Return labels as a hashable, sorted tuple of (name, value) pairs, leaving out those that are None."""
+    return tuple(sorted((name, str(value)) for name, value in labels.items() if value is not None))
+
+
+def _format_labels(labels):
+    """Format (name, value) pairs as Prometheus labels."""
+    if not labels:
+        return ''
+    return '{' + ','.join(name + '="' + value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for name, value in labels) + '}'
+
+
+registry = Metrics()
+inc = registry.inc
+observe = registry.observe
+timer = registry.timer
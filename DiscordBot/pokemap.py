@@ -1,11 +1,46 @@
 """This module implements the functions and classes for making maps of research tasks in pokemon go."""
 
+import asyncio
+import collections
+import contextlib
 import datetime
+import heapq
+import itertools
+import json
+import math
+import os
+import time
 import pygeoj
 import pickle
 import pytz
 import copy
+import csv
+import gzip
+import io
+import threading
 from fuzzywuzzy import fuzz
+import metrics
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GRID_SIZE = 0.005   # Size of the spatial index cells in degrees, roughly 500m of latitude
+DUPLICATE_RADIUS = 2   # Stops closer together than this many meters are treated as the same stop
+EARTH_RADIUS = 6371000   # Mean radius of the earth in meters
+SHADOW_DURATION = 1800   # Seconds a rocket raid lasts after it is reported
+PUBLISH_PRECISION = 5   # Decimal places kept in published coordinates, about a meter
+PUBLISHED_PROPERTIES = ('Stop Name', 'Task', 'Reward', 'Category', 'Icon', 'Shadow Pokemon')   # Properties the web map uses
+TILE_ZOOM = 15   # Zoom level of the tiles holding individual stops, used by the web map at this zoom and closer
+CLUSTER_ZOOMS = (13, 14)   # Zoom levels that get tiles of clustered stops instead
+CLUSTER_DEPTH = 3   # Clusters are cells this many zoom levels below their tile, so each tile is split 8 by 8
+CHANGE_HISTORY = 1000   # Number of recent stop changes each map keeps for clients catching up on changes
+FUZZY_BIGRAM_SHARE = 0.34   # Strings scoring over 80 with fuzz.partial_ratio share at least this many bigrams per character of the shorter one, less one
+STOP_TRIGRAM_SHARE = 0.25   # Share of its trigrams a message must have in common with a single stop name to be looked up as one
+IMPORT_NAME_RADIUS = 50   # Imported stops with the same name as a stop this many meters away are treated as duplicates
+REPORT_SEPARATORS = (' / ', ' - ', ' | ', ', ', '/', '|', ',')   # Separators tried between the stop and task on each line of a bulk report
+TASKLIST_VERSION = 1   # Version of the tasklist file format, checked when loading
+TASK_FIELDS = {'reward': str, 'quest': str, 'shiny': bool, 'nicknames': list, 'reward_type': str, 'rewards': list, 'icon': str}
 
 
 class Task:
@@ -15,7 +50,7 @@ class Task:
         """Initialize the task object and parse the input name into the rewards if possible."""
         self.reward = name.title()
         self.quest = quest
-        self.shiny = shiny
+        self.shiny = _to_bool(shiny)
         self.nicknames = []
         if 'Rare' in self.reward:    # Check to see what the reward type is
             self.reward_type = 'Rare Candy'
@@ -42,6 +77,9 @@ class Task:
         """Add a nickname to the task."""
         if not(name in self.nicknames):
             self.nicknames.append(name)
+            tasklist = getattr(self, '_tasklist', None)
+            if tasklist is not None:
+                tasklist._task_changed(self)
 
     def set_icon(self, icon):
         """Choose which reward to use as the icon."""
@@ -49,6 +87,39 @@ class Task:
         if icon in self.rewards:
             self.icon = icon
 
+    def keys(self):
+        """Return the normalized strings the task can be found by."""
+        keys = [self.reward.title(), self.quest.replace('é', 'e').title()]
+        keys.extend(reward.title() for reward in self.rewards)
+        keys.extend(nickname.title() for nickname in self.nicknames)
+        return keys
+
+    def to_dict(self):
+        """Return the task as a dictionary of JSON compatible values."""
+        return {'reward': self.reward, 'quest': self.quest, 'shiny': self.shiny, 'nicknames': list(self.nicknames),
+                'reward_type': self.reward_type, 'rewards': list(self.rewards), 'icon': self.icon}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Create a task from a dictionary made by to_dict."""
+        task = cls(data['reward'], data['quest'], data['shiny'])
+        task.nicknames = list(data['nicknames'])
+        task.reward_type = data['reward_type']
+        task.rewards = list(data['rewards'])
+        task.icon = data['icon']
+        return task
+
+    def __getstate__(self):
+        """Leave the tasklist back-reference out of the pickle."""
+        state = self.__dict__.copy()
+        state.pop('_tasklist', None)
+        return state
+
+    def __setstate__(self, state):
+        """Restore a pickled task, fixing up shiny flags pickled as strings by older versions."""
+        self.__dict__.update(state)
+        self.shiny = _to_bool(self.shiny)
+
 
 class Tasklist:
     """Tasklist class."""
@@ -56,88 +127,205 @@ class Tasklist:
     def __init__(self):
         """Initialize the tasklist."""
         self.tasks = []
+        self._index = {}
+        self._log = None
+
+    def __getstate__(self):
+        """Leave the lookup index out of the pickle."""
+        state = self.__dict__.copy()
+        state.pop('_index', None)
+        state.pop('_save_lock', None)
+        state.pop('_log', None)
+        return state
+
+    def __setstate__(self, state):
+        """Rebuild the lookup index when unpickling, including tasklists pickled before it existed."""
+        self.__dict__.update(state)
+        self._log = None
+        self._build_index()
+
+    def _build_index(self):
+        """Rebuild the map from normalized reward, quest and nickname strings to tasks."""
+        self._index = {}
+        for task in self.tasks:
+            self._index_task(task)
+
+    def _index_task(self, task):
+        """Add a task's keys to the index, earlier tasks taking priority as in the original search order."""
+        task._tasklist = self
+        for key in task.keys():
+            self._index.setdefault(key, task)
 
     def add_task(self, task):
         """Add a task to the tasklist."""
         self.tasks.append(task)
+        self._index_task(task)
+        self._record({'op': 'add', 'task': task.to_dict()})
 
     def find_task(self, task_str):
         """Find a task in the list and return it."""
-        task_str = task_str.replace('é', 'e').title()
-        task_not_found = True
-        custom_quest = False
-        if ":" in task_str:
-            task_strs = task_str.split(":")
-            task_str = task_strs[0]
-            quest_str = task_strs[1]
-            custom_quest = True
-        while task_not_found:
-            for task in self.tasks:
-                if (task_str == task.reward.title()) or (task_str == task.quest.replace('é', 'e').title()) or (task_str in (reward.title() for reward in task.rewards)) or (task_str in (nickname.title() for nickname in task.nicknames)):
-                    out_task = task
-                    task_not_found = False
-                    if custom_quest:
-                        out_task = copy.copy(task)
-                        out_task.quest = quest_str.title()
-                    return out_task
-            break
-        if task_not_found:
-            raise TaskNotFound()
+        with metrics.timer('pokemap_find_task_seconds'):
+            task_str = task_str.replace('é', 'e').title()
+            custom_quest = False
+            if ":" in task_str:
+                task_strs = task_str.split(":")
+                task_str = task_strs[0]
+                quest_str = task_strs[1]
+                custom_quest = True
+            task = self._index.get(task_str)
+            if task is None:
+                raise TaskNotFound()
+            if custom_quest:
+                task = copy.copy(task)
+                task.quest = quest_str.title()
+            return task
 
     def remove_task(self, task):
         """Remove a task from the list."""
         for i, item in enumerate(self.tasks):
             if item is task:
                 del self.tasks[i]
+                self._record({'op': 'delete', 'index': i})
+                break
+        self._build_index()
+
+    def _task_changed(self, task):
+        """Reindex and log a task after it is edited."""
+        self._build_index()
+        for i, item in enumerate(self.tasks):
+            if item is task:
+                self._record({'op': 'update', 'index': i, 'task': task.to_dict()})
+                break
 
-    def save(self, filename='tasklist.pkl'):
-        """Save the tasklist."""
-        with open(filename, 'wb') as output:
-            pickle.dump(self, output, pickle.HIGHEST_PROTOCOL)
+    def open_log(self, filename):
+        """Append a record to filename for each change to the tasklist from now on, instead of rewriting it."""
+        self.close_log()
+        self._log = open(filename, 'a')
+
+    def close_log(self):
+        """Stop logging changes."""
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def _record(self, record):
+        """Append a change to the log, if there is one."""
+        if self._log is None:
+            return
+        self._log.write(json.dumps(record) + '\n')
+        self._log.flush()
+
+    def save(self, filename='tasklist.jsonl'):
+        """Save the whole tasklist, as a version header followed by one record per task."""
+        logging = self._log is not None and os.path.abspath(self._log.name) == os.path.abspath(filename)
+        if logging:
+            self.close_log()
+        _write_atomic(filename, self._write)
+        if logging:
+            self.open_log(filename)
+
+    def _write(self, file):
+        """Write the tasklist in the JSON lines format read by read_tasklist."""
+        file.write(json.dumps({'format': 'tasklist', 'version': TASKLIST_VERSION}) + '\n')
+        for task in self.tasks:
+            file.write(json.dumps({'op': 'add', 'task': task.to_dict()}) + '\n')
+
+    def snapshot(self):
+        """Return a copy of the tasklist that later edits won't change, for saving in the background."""
+        snapshot = Tasklist()
+        for task in self.tasks:
+            task_copy = copy.copy(task)
+            task_copy.nicknames = list(task.nicknames)
+            task_copy.rewards = list(task.rewards)
+            snapshot.tasks.append(task_copy)
+        return snapshot
+
+    async def save_async(self, filename='tasklist.jsonl', executor=None):
+        """Save a snapshot of the tasklist on an executor thread, in the order the saves were requested."""
+        snapshot = self.snapshot()
+        if getattr(self, '_save_lock', None) is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            await asyncio.get_event_loop().run_in_executor(executor, snapshot.save, filename)
 
     def clear(self):
         """Clear the tasklist."""
         self.tasks = []
+        self._index = {}
+        if self._log is not None:
+            self.save(self._log.name)
 
 
 class Stop(pygeoj.Feature):
-    """Extension of the pygeoj feature class that includes more methods that are useful for pokestops."""
-
-    def reset(self):
-        """Remove the task associated with the stop."""
+    """Extension of the pygeoj feature class that includes more methods that are useful for pokestops.
+
+    Stops are created once by the map that owns them and reused, so they keep a reference back to it in _map.
+    """
+
+    def __init__(self, obj=None, geometry=None, properties=None, taskmap=None):
+        """Wrap a feature, optionally recording the map it belongs to."""
+        super().__init__(obj, geometry, properties)
+        self._map = taskmap
+
+    def lat_long(self):
+        """Return the latitude and longitude of the stop."""
+        coordinates = self._data['geometry']['coordinates']
+        return coordinates[1], coordinates[0]
+
+    def key(self):
+        """Return the name and coordinates of the stop, used to identify it in the map journal."""
+        coordinates = self._data['geometry']['coordinates']
+        return (self.properties['Stop Name'], coordinates[0], coordinates[1])
+
+    def _changed(self, op):
+        """Let the map know the stop has been edited."""
+        if self._map is not None:
+            self._map._record(op, self)
+
+    def reset(self, day=None):
+        """Remove the task associated with the stop, optionally passing in the current day of the year."""
+        if day is None:
+            day = int(self._map.now().strftime("%j"))
         self.task = None
         self.properties['Task'] = ''
         self.properties['Reward'] = ''
         self.properties['Category'] = ''
-        self.properties['Last Edit'] = int(self._map.now().strftime("%j"))
+        self.properties['Last Edit'] = day
         self.properties['Icon'] = ''
         self.properties['Shadow Pokemon'] = ''
         self.properties['Shadow Time'] = ''
         self.properties['Old_Category'] = ''
         self.properties['Old_Icon'] = ''
+        self._changed('reset')
 
-    def set_task(self, task):
-        """Add a task to the stop."""
+    def set_task(self, task, reward=None):
+        """Add a task to the stop, using reward as the icon if it is one of the task's rewards."""
         if self.properties['Task'] == '':
+            icon = task.icon
+            if reward is not None and reward.title() in task.rewards:
+                icon = reward.title()
             self.properties['Task'] = task.quest
             self.properties['Last Edit'] = int(self._map.now().strftime("%j"))
             if self.properties['Category'] == 'Shadow':
                 self.properties['Old_Category'] = task.reward_type
-                self.properties['Old_Icon'] = task.icon
+                self.properties['Old_Icon'] = icon
             else:
                 self.properties['Category'] = task.reward_type
-                self.properties['Icon'] = task.icon
+                self.properties['Icon'] = icon
             self.properties['Reward'] = task.reward
+            self._changed('set_task')
         else:
             raise TaskAlreadyAssigned(self, task)
 
     def set_shadow(self, pokemon=None):
-        """Mark a stop as subject to a rocket raid."""
-        self.shadow_time = datetime.datetime.now()
+        """Mark a stop as subject to a rocket raid, which ends SHADOW_DURATION seconds after it was first reported."""
         if self.properties['Shadow Time'] == '':
-            self.properties['Shadow Time'] = int(self._map.now().strftime("%X").replace(':', ''))
+            self.properties['Shadow Time'] = int(time.time())
             self.properties['Old_Category'] = self.properties['Category']
             self.properties['Old_Icon'] = self.properties['Icon']
+            if self._map is not None:
+                self._map._track_shadow(self)
+        self.shadow_time = self.properties['Shadow Time']
         self.properties['Category'] = 'Shadow'
         if pokemon is not None:
             self.properties['Shadow Pokemon'] = 'a shadow ' + pokemon
@@ -145,6 +333,7 @@ class Stop(pygeoj.Feature):
         else:
             self.properties['Shadow Pokemon'] = 'an unknown shadow pokemon'
             self.properties['Icon'] = 'Shadow'
+        self._changed('set_shadow')
 
     def reset_shadow(self):
         """Remove rocket raid from the stop."""
@@ -154,6 +343,28 @@ class Stop(pygeoj.Feature):
         self.properties['Shadow Time'] = ''
         self.properties['Category'] = self.properties['Old_Category']
         self.properties['Icon'] = self.properties['Old_Icon']
+        self._changed('reset_shadow')
+
+    def report(self, report, tasklist):
+        """Apply a report of a task, or of a rocket raid if it mentions a shadow, as reported in chat.
+
+        Reporting the task a stop already has is accepted rather than raising TaskAlreadyAssigned.
+        """
+        if 'shadow' in report.lower():
+            pokemon = report.split()[-1]
+            if 'shadow' in pokemon.lower():
+                self.set_shadow()
+            elif 'gone' in report.lower():
+                self.reset_shadow()
+            else:
+                self.set_shadow(pokemon)
+        else:
+            task = tasklist.find_task(report)
+            try:
+                self.set_task(task, report)
+            except TaskAlreadyAssigned:
+                if self.properties['Reward'] != task.reward:
+                    raise
 
     def add_new_attributes(self):
         """Add new attributes that a stop may be missing for updates in the middle of a day."""
@@ -162,25 +373,167 @@ class Stop(pygeoj.Feature):
 
     def add_nickname(self, nickname):
         """Add a nickname to a stop."""
+        if self._map is not None:
+            self._map._unindex_stop_names(self)
         if 'Nicknames' not in self.properties:
             self.properties['Nicknames'] = []
         if (len(self.properties['Nicknames']) == 1 and self.properties['Nicknames'][0].startswith('Temp')):
             self.properties['Nicknames'][0] = nickname.title()
         else:
             self.properties['Nicknames'].append(nickname.title())
+        if self._map is not None:
+            self._map._index_stop_names(self)
+        self._changed('add_nickname')
 
 
 class ResearchMap(pygeoj.GeojsonFile):  # TODO Add map boundary here and a default one that checks for proper long/lat formating
     """Class for the research map. Hopefully this will allow for multiple servers with seperate maps to be stored easily at once."""
 
+    def __init__(self, filepath=None, data=None, **kwargs):
+        """Load the map, wrap each feature in a Stop and build the lookup indexes for the stop names."""
+        super().__init__(filepath, data, **kwargs)
+        self._stops = []
+        self._name_index = {}
+        self._trigram_index = {}
+        self._bigram_index = {}
+        self._fuzzy_stops = {}
+        self._short_stops = {}
+        self._stop_counter = itertools.count()
+        self._grid = {}
+        self._dirty_since = None
+        self._unpublished_since = None
+        self._save_lock = None
+        self._write_lock = threading.Lock()
+        self._saves_started = 0
+        self._saves_written = 0
+        self._journal = None
+        self._journal_paused = False
+        self._journal_seq = self._data.get('journal_seq', 0)
+        self._storage = None
+        self._storage_key = None
+        self._tiles_dir = None
+        self._dirty_tiles = set()
+        self._version = int(time.time() * 1000)
+        self._changes = collections.deque(maxlen=CHANGE_HISTORY)
+        self._listeners = []
+        self._shadow_heap = []
+        self.guild = None
+        for featuredict in self._data["features"]:
+            stop = Stop(featuredict, taskmap=self)
+            self._stops.append(stop)
+            self._index_stop(stop)
+            if stop.properties.get('Category') == 'Shadow':
+                self._track_shadow(stop)
+
     def __getitem__(self, index):
         """Get a feature based on its index, like geojfile[7]."""
-        return Stop(self._data["features"][index])
+        return self._stops[index]
+
+    def update_bbox(self):
+        """Recalculate the bounding box of the map from the raw features, leaving it alone if there are none."""
+        if self._data["features"]:
+            self._data["bbox"] = _features_bbox(self._data["features"])
 
     def __iter__(self):
         """Iterate through and yields each feature in the file."""
-        for featuredict in self._data["features"]:
-            yield Stop(featuredict)
+        for stop in self._stops:
+            yield stop
+
+    def __setitem__(self, index, stop):
+        """Replace a feature based on its index with a new one, like geojfile[7] = newstop."""
+        self._unindex_stop(self._stops[index])
+        if not isinstance(stop, Stop):
+            stop = Stop(stop)
+        stop._map = self
+        self._data["features"][index] = stop._data
+        self._stops[index] = stop
+        self._index_stop(stop)
+
+    def __delitem__(self, index):
+        """Delete a feature based on its index, like del geojfile[7]."""
+        self._unindex_stop(self._stops[index])
+        self._record('remove_stop', self._stops[index])
+        del self._data["features"][index]
+        del self._stops[index]
+
+    def _index_stop(self, stop):
+        """Add a stop to the lookup indexes."""
+        self._index_stop_names(stop)
+        name = stop.properties['Stop Name'].title()
+        self._fuzzy_stops[stop] = (next(self._stop_counter), len(name))
+        for gram in _trigrams(name):
+            self._trigram_index.setdefault(gram, set()).add(stop)
+        for gram, count in _bigrams(name).items():
+            self._bigram_index.setdefault(gram, {})[stop] = count
+        if len(name) < 3:
+            self._short_stops[stop] = None
+        self._grid.setdefault(_grid_cell(*stop.lat_long()), []).append(stop)
+
+    def _unindex_stop(self, stop):
+        """Remove a stop from the lookup indexes."""
+        self._unindex_stop_names(stop)
+        cell = _grid_cell(*stop.lat_long())
+        stops = self._grid.get(cell, [])
+        for i, item in enumerate(stops):
+            if item is stop:
+                del stops[i]
+                break
+        if not stops:
+            self._grid.pop(cell, None)
+        self._fuzzy_stops.pop(stop, None)
+        self._short_stops.pop(stop, None)
+        name = stop.properties['Stop Name'].title()
+        for gram in _trigrams(name):
+            stops = self._trigram_index.get(gram)
+            if stops is not None:
+                stops.discard(stop)
+                if not stops:
+                    del self._trigram_index[gram]
+        for gram in _bigrams(name):
+            stops = self._bigram_index.get(gram)
+            if stops is not None:
+                stops.pop(stop, None)
+                if not stops:
+                    del self._bigram_index[gram]
+
+    def _index_stop_names(self, stop):
+        """Add a stop's name and nicknames to the exact lookup index."""
+        for key in _stop_keys(stop.properties):
+            self._name_index.setdefault(key, []).append(stop)
+
+    def _unindex_stop_names(self, stop):
+        """Remove a stop's name and nicknames from the exact lookup index."""
+        for key in _stop_keys(stop.properties):
+            stops = self._name_index.get(key, [])
+            for i, item in enumerate(stops):
+                if item is stop:
+                    del stops[i]
+                    break
+            if not stops:
+                self._name_index.pop(key, None)
+
+    def _fuzzy_candidates(self, stop_name):
+        """Shortlist the stops that could score over 80 with fuzz.partial_ratio against a search string.
+
+        A partial ratio over 80 lines the shorter string, of length m, up with part of the longer one so that at most
+        19.5% of their characters are left unmatched. Each unmatched character splits the matching characters into
+        one more run, and every pair of neighbouring characters within a run is a bigram found in both strings, so
+        they share at least 0.347 * m - 1 bigrams (counting repeats), and at least one once m is 3 or more. Stops
+        sharing fewer than that are left out, which can never change the result of find_stop. Searches shorter than 3
+        characters fall back to every stop.
+        """
+        if len(stop_name) < 3:
+            return list(self._stops)
+        counts = {}
+        for gram, count in _bigrams(stop_name).items():
+            for stop, stop_count in self._bigram_index.get(gram, {}).items():
+                counts[stop] = counts.get(stop, 0) + min(count, stop_count)
+        candidates = list(self._short_stops)
+        for stop, count in counts.items():
+            if count >= max(1, FUZZY_BIGRAM_SHARE * min(self._fuzzy_stops[stop][1], len(stop_name)) - 1) and stop not in self._short_stops:
+                candidates.append(stop)
+        candidates.sort(key=lambda stop: self._fuzzy_stops[stop][0])
+        return candidates
 
     def add_stop(self, obj=None, geometry=None, properties=None):
         r"""
@@ -191,98 +544,318 @@ class ResearchMap(pygeoj.GeojsonFile):  # TODO Add map boundary here and a defau
         - **geometry** (optional): Anything that the Geometry instance can accept.
         - **properties** (optional): A dictionary of key-value property pairs.
 
+        Returns the Stop that was added.
         """
         properties = properties or {}
         if isinstance(obj, Stop):
             # instead of creating copy, the original feat should reference the same one that was added here
-            feat = obj._data
+            stop = obj
         elif isinstance(obj, dict):
-            feat = obj.copy()
+            stop = Stop(obj.copy())
         else:
-            feat = Stop(geometry=geometry, properties=properties).__geo_interface__
-            feat._map = self
-        self._data["features"].append(feat)
+            stop = Stop(geometry=geometry, properties=properties)
+        stop._map = self
+        self._data["features"].append(stop._data)
+        self._stops.append(stop)
+        self._index_stop(stop)
+        self._record('add_stop', stop)
+        return stop
 
     def find_stop(self, stop_name):
         """Find a stop within the map by its name or nickname."""
-        stops_found = []
-        stop_name = stop_name.replace('’', "'")
-        if '\n' in stop_name:
-            raise StopNotFound
-        for stop in self:
-            if (stop.properties['Stop Name'].title() == stop_name.title()) or (stop_name.title() in stop.properties['Nicknames']) or (stop_name in stop.properties['Nicknames']):
-                if stop.properties['Last Edit'] != int(self.now().strftime("%j")):
-                    self.reset_all
-                stops_found.append(stop)
-        if len(stops_found) == 0:
-            best_ratio = 0
-            best_stop = None
-            for stop in self:
-                ratio = fuzz.partial_ratio(stop.properties['Stop Name'].title(), stop_name.title())
-                if ratio > 80 and ratio > best_ratio:
-                    best_ratio = ratio
-                    best_stop = stop
-                elif ratio == 100:
+        start = time.perf_counter()
+        path = 'exact'
+        try:
+            stop_name = stop_name.replace('’', "'")
+            if '\n' in stop_name:
+                raise StopNotFound
+            stops_found = list(self._name_index.get(_normalize_name(stop_name), []))
+            if len(stops_found) == 0:
+                path = 'fuzzy'
+                best_ratio = 0
+                best_stop = None
+                for stop in self._fuzzy_candidates(stop_name.title()):
+                    ratio = fuzz.partial_ratio(stop.properties['Stop Name'].title(), stop_name.title())
+                    if ratio > 80 and ratio > best_ratio:
+                        best_ratio = ratio
+                        best_stop = stop
+                    elif ratio == 100:
+                        raise StopNotFound()
+                if best_stop is not None:
+                    return best_stop
+                else:
                     raise StopNotFound()
-            if best_stop is not None:
-                best_stop._map = self
-                return best_stop
+            elif len(stops_found) == 1:
+                return stops_found[0]
             else:
-                raise StopNotFound()
-        elif len(stops_found) == 1:
-            stops_found[0]._map = self
-            return stops_found[0]
+                temp_num = 1
+                for stop in stops_found:
+                    if not(stop.properties['Nicknames']):
+                        stop.add_nickname('Temp' + str(temp_num))
+                        temp_num += 1
+                raise MutlipleStopsFound(stops_found)
+        finally:
+            metrics.observe('pokemap_find_stop_seconds', time.perf_counter() - start, guild=self.guild, path=path)
+
+    def apply_reports(self, text, tasklist):
+        """Apply every report in a multi-line message in one pass, returning a (report, stop, error) tuple for each.
+
+        A message of two lines without any of REPORT_SEPARATORS is a stop followed by its report, as in a report made in
+        two messages. Otherwise each line with a separator is a stop followed by its report, and other lines are
+        ignored. The error is None for reports that were applied, otherwise it is the message of the exception that
+        stopped it. If no report could be applied the message is most likely ordinary chat, so an empty list is
+        returned. Nothing is saved, so saving once afterwards covers every report.
+        """
+        lines = [line.strip() for line in text.split('\n') if line.strip()]
+        separated = [line for line in lines if any(separator in line for separator in REPORT_SEPARATORS)]
+        if len(lines) == 2 and not separated:
+            reports = [(lines[0] + ' / ' + lines[1], (lines[0], lines[1]))]
         else:
-            temp_num = 1
-            for stop in stops_found:
-                if not(stop.properties['Nicknames']):
-                    stop.properties['Nicknames'].append('Temp' + str(temp_num))
-                    temp_num += 1
-            raise MutlipleStopsFound(stops_found)
-
-    def new_stop(self, coordinates, name):   # TODO Add check for being in the map range
+            reports = [(line, None) for line in separated]
+        results = []
+        for line, pair in reports:
+            stop = None
+            try:
+                if pair is None:
+                    stop, report = self._split_report(line, tasklist)
+                else:
+                    stop = self.find_stop(pair[0])
+                    report = pair[1]
+                stop.report(report, tasklist)
+                results.append((line, stop, None))
+            except PokemapException as e:
+                results.append((line, stop, e.message))
+        if all(error is not None for line, stop, error in results):
+            return []
+        return results
+
+    def _split_report(self, line, tasklist):
+        """Split a line of a bulk report into its stop and report.
+
+        Each separator is tried in turn, so stop names containing a separator still work. The first split where both
+        the stop and the report are recognised wins, otherwise the first split where the stop is found.
+        """
+        fallback = None
+        for separator in REPORT_SEPARATORS:
+            start = line.find(separator)
+            while start != -1:
+                stop_name = line[:start].strip()
+                report = line[start + len(separator):].strip()
+                if stop_name and report and self.could_be_stop(stop_name):
+                    try:
+                        stop = self.find_stop(stop_name)
+                    except StopNotFound:
+                        stop = None
+                    if stop is not None:
+                        if 'shadow' in report.lower():
+                            return stop, report
+                        try:
+                            tasklist.find_task(report)
+                            return stop, report
+                        except TaskNotFound:
+                            if fallback is None:
+                                fallback = (stop, report)
+                start = line.find(separator, start + 1)
+        if fallback is None:
+            raise StopNotFound()
+        return fallback
+
+    def could_be_stop(self, stop_name):
+        """Cheaply check whether find_stop might find a stop from a string, without scoring any fuzzy matches.
+
+        Strings that aren't a name or nickname are only accepted if they have STOP_TRIGRAM_SHARE of their trigrams in
+        common with a single stop name, which realistic misspellings do while chat that mentions a word of a stop name
+        doesn't, though find_stop itself scores more loosely. Strings too short to have trigrams, and stop names too
+        short to have any, are only accepted as exact names, since find_stop would match a short name to anything
+        containing it.
+        """
+        stop_name = stop_name.replace('’', "'")
+        if '\n' in stop_name:
+            return False
+        if _normalize_name(stop_name) in self._name_index:
+            return True
+        query_grams = sorted(_trigrams(stop_name.title()), key=lambda gram: len(self._trigram_index.get(gram, ())))
+        if not query_grams:
+            return False
+        needed = max(1, math.ceil(STOP_TRIGRAM_SHARE * len(query_grams)))
+        checked = set()
+        for gram in query_grams[:len(query_grams) - needed + 1]:   # A stop with enough trigrams has one of these rarest ones
+            for stop in self._trigram_index.get(gram, ()):
+                if stop not in checked:
+                    checked.add(stop)
+                    if sum(1 for other in query_grams if stop in self._trigram_index.get(other, ())) >= needed:
+                        return True
+        return False
+
+    def nearby(self, lat, long, radius):
+        """Return (distance, stop) pairs for every stop within radius meters of a point, closest first."""
+        lat_cells = radius / (EARTH_RADIUS * math.radians(GRID_SIZE))
+        long_cells = lat_cells / max(math.cos(math.radians(lat)), 0.01)
+        lat_cell, long_cell = _grid_cell(lat, long)
+        lat_range = range(lat_cell - math.ceil(lat_cells), lat_cell + math.ceil(lat_cells) + 1)
+        long_range = range(long_cell - math.ceil(long_cells), long_cell + math.ceil(long_cells) + 1)
+        found = []
+        for i in lat_range:
+            for j in long_range:
+                for stop in self._grid.get((i, j), ()):
+                    dist = distance(lat, long, *stop.lat_long())
+                    if dist <= radius:
+                        found.append((dist, stop))
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+    def new_stop(self, coordinates, name):
         """Add a new stop to the map."""
         name = name.replace('’', "'")
+        duplicates = self.nearby(coordinates[1], coordinates[0], DUPLICATE_RADIUS)
+        if duplicates:
+            raise StopAlreadyExists(duplicates[0][1])
         if ((self._data['bounds'][0] < coordinates[1] < self._data['bounds'][2]) and (self._data['bounds'][1] < coordinates[0] < self._data['bounds'][3])) or ((self._data['bounds'][2] < coordinates[1] < self._data['bounds'][0]) and (self._data['bounds'][3] < coordinates[0] < self._data['bounds'][1])):
-            self.add_stop(properties={'marker-size': 'medium', 'marker-symbol': '', 'marker-color': '#808080', 'Stop Name': name, 'Task': '', 'Reward': '',
-                                      'Last Edit': int(self.now().strftime("%j")), 'Nicknames': []
-                                      },
-                          geometry={"type": "Point", "coordinates": coordinates, "bbox": [coordinates[0], coordinates[1], coordinates[0], coordinates[1]]})
+            self._add_new_stop(coordinates, name, int(self.now().strftime("%j")))
         else:
             raise StopOutsideBoundary()
 
+    def _add_new_stop(self, coordinates, name, day):
+        """Add a stop with no task, without any checks."""
+        return self.add_stop(properties={'marker-size': 'medium', 'marker-symbol': '', 'marker-color': '#808080', 'Stop Name': name, 'Task': '', 'Reward': '',
+                                         'Last Edit': day, 'Nicknames': [], 'Category': '', 'Icon': '', 'Shadow Pokemon': '',
+                                         'Shadow Time': '', 'Old_Category': '', 'Old_Icon': ''
+                                         },
+                             geometry={"type": "Point", "coordinates": coordinates, "bbox": [coordinates[0], coordinates[1], coordinates[0], coordinates[1]]})
+
+    def import_stops(self, rows):
+        """Add many stops at once from (name, lat, long) rows, such as those from read_stops.
+
+        The bounds are checked against all rows in one pass first. Rows within DUPLICATE_RADIUS of a stop, or with the
+        name of a stop within IMPORT_NAME_RADIUS, are skipped as duplicates, including of rows added earlier in the
+        import. The additions aren't journaled, so the map should be saved once afterwards. Returns a Counter of how
+        many rows were 'added', 'duplicate', 'outside' the bounds or 'invalid'.
+        """
+        if 'bounds' not in self._data:
+            raise BoundsNotSet()
+        bounds = self._data['bounds']
+        lat_min, lat_max = sorted((bounds[0], bounds[2]))
+        long_min, long_max = sorted((bounds[1], bounds[3]))
+        counts = collections.Counter()
+        inside = []
+        for name, lat, long in rows:
+            try:
+                lat = float(lat)
+                long = float(long)
+            except (TypeError, ValueError):
+                counts['invalid'] += 1
+                continue
+            name = str(name).replace('’', "'").strip()
+            if not name:
+                counts['invalid'] += 1
+            elif lat_min < lat < lat_max and long_min < long < long_max:
+                inside.append((name, lat, long))
+            else:
+                counts['outside'] += 1
+        day = int(self.now().strftime("%j"))
+        with self._bulk_edit():
+            for name, lat, long in inside:
+                normalized = _normalize_name(name)
+                nearby = self.nearby(lat, long, IMPORT_NAME_RADIUS)
+                if any(dist <= DUPLICATE_RADIUS or _normalize_name(stop.properties['Stop Name']) == normalized for dist, stop in nearby):
+                    counts['duplicate'] += 1
+                    continue
+                self._add_new_stop([long, lat], name, day)
+                counts['added'] += 1
+        return counts
+
     def reset_old(self):
-        """Check for and reset only old stops in the map. This should get deprecated by moving the last edit to the map properties."""
+        """Check for and reset only old stops in the map, and clear expired rocket raids.
+
+        The midnight resets aren't journaled, the map should be saved afterwards if any stops were reset.
+        """
+        with metrics.timer('pokemap_reset_old_seconds', guild=self.guild):
+            rolled_over = self.rollover()
+            shadows_reset = self.expire_shadows()
+        return rolled_over or shadows_reset
+
+    def rollover(self):
+        """Reset the stops edited before today if the day has changed since the map was last reset.
+
+        The map keeps the date of its last reset, so this is a single comparison until the day changes. Returns True if
+        stops were reset, which aren't journaled so the map should be saved afterwards.
+        """
+        now = self.now()
+        today = now.strftime("%Y-%m-%d")
+        if self._data.get('day') == today:
+            return False
+        self._data['day'] = today
+        day = int(now.strftime("%j"))
         stops_reset = False
-        for stop in self:
-            if stop.properties['Last Edit'] != int(self.now().strftime("%j")):
-                stop._map = self
-                stop.reset()
+        with self._bulk_edit():
+            for stop in self:
+                if stop.properties.get('Last Edit') != day or 'Shadow Time' not in stop.properties:
+                    stop.reset(day)
+                    stops_reset = True
+        return stops_reset
+
+    def _track_shadow(self, stop):
+        """Add a stop's rocket raid to the heap of raid end times.
+
+        Older maps stored the time of day a raid was reported as an HHMMSS integer, these are converted to unix times.
+        """
+        start = stop.properties.get('Shadow Time')
+        if not isinstance(start, (int, float)):
+            return
+        if start < 240000:
+            now = self.now()
+            reported = now.replace(hour=start // 10000, minute=start // 100 % 100, second=start % 100, microsecond=0)
+            if reported > now:
+                reported -= datetime.timedelta(days=1)
+            start = int(reported.timestamp())
+            stop.properties['Shadow Time'] = start
+        heapq.heappush(self._shadow_heap, (start + SHADOW_DURATION, next(self._stop_counter), stop, start))
+
+    def next_shadow_expiry(self):
+        """Return the unix time the next rocket raid in the map ends, or None if there are none."""
+        while self._shadow_heap:
+            expiry, _, stop, start = self._shadow_heap[0]
+            if stop in self._fuzzy_stops and stop.properties.get('Category') == 'Shadow' and stop.properties.get('Shadow Time') == start:
+                return expiry
+            heapq.heappop(self._shadow_heap)
+        return None
+
+    def expire_shadows(self, now=None):
+        """Clear the rocket raids that have ended, only looking at the raids that are due. Returns True if any were."""
+        if now is None:
+            now = time.time()
+        stops_reset = False
+        while self._shadow_heap and self._shadow_heap[0][0] <= now:
+            expiry, _, stop, start = heapq.heappop(self._shadow_heap)
+            if stop in self._fuzzy_stops and stop.properties.get('Category') == 'Shadow' and stop.properties.get('Shadow Time') == start:
+                stop.reset_shadow()
                 stops_reset = True
-            else:
-                try:
-                    if stop.properties['Category'] == 'Shadow':
-                        delta = (int(self.now().strftime("%X").replace(':', '')) - stop.properties["Shadow Time"])
-                        if (delta > 3000) or (delta < 0):
-                            stop.reset_shadow()
-                            stops_reset = True
-                except KeyError:
-                    stop._map = self
-                    stop.reset()
         return stops_reset
 
+    def next_rollover(self):
+        """Return the unix time of the next midnight in the map's timezone."""
+        now = self.now()
+        tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+        return pytz.timezone(self._data.get('timezone', 'UTC')).localize(tomorrow).timestamp()
+
     def reset_all(self):
-        """Reset all the stops in the map."""
-        for i, stop in enumerate(self):
-            stop._map = self
-            stop.reset()
+        """Reset all the stops in the map. These resets aren't journaled, the map should be saved afterwards."""
+        now = self.now()
+        day = int(now.strftime("%j"))
+        self._data['day'] = now.strftime("%Y-%m-%d")
+        with self._bulk_edit():
+            for stop in self:
+                stop.reset(day)
 
     def remove_stop(self, stop):
         """Remove a stop from the map."""
-        for i, item in enumerate(self):
-            if item.properties == stop.properties:
-                del self[i]
-                break
+        if stop._map is self:
+            del self[self._stops.index(stop)]
+        else:
+            for i, item in enumerate(self):
+                if item.properties == stop.properties:
+                    del self[i]
+                    break
 
     def set_time_zone(self, tz_str):     # TODO Figure out how to implement this as a nonfeature property
         """Set the maps time zone."""
@@ -291,6 +864,18 @@ class ResearchMap(pygeoj.GeojsonFile):  # TODO Add map boundary here and a defau
         else:
             raise InvalidTimezone()
 
+    @property
+    def report_channels(self):
+        """Ids of the channels reports are looked for in, or an empty list to look in every channel."""
+        return self._data.get('report_channels', [])
+
+    def set_report_channel(self, channel_id, allowed=True):
+        """Add a channel to or remove it from the channels reports are looked for in."""
+        channels = [channel for channel in self.report_channels if channel != channel_id]
+        if allowed:
+            channels.append(channel_id)
+        self._data['report_channels'] = channels
+
     def now(self):
         """Return the time in the maps timezone."""
         if 'timezone' in self._data:
@@ -321,17 +906,914 @@ class ResearchMap(pygeoj.GeojsonFile):  # TODO Add map boundary here and a defau
         else:
             self._data['bounds'] = [coords1[0], coords1[1], coords2[0], coords2[1]]
 
+    def enable_journal(self, filename=None):
+        """Start logging every stop edit to an append-only journal next to the map file.
+
+        Each edit is written as one JSON line straight away, and saving the map compacts the journal into the map.
+        """
+        if filename is None:
+            filename = self._data['path'] + '.journal'
+        self._journal = open(filename, 'a')
+
+    def close_journal(self):
+        """Stop logging edits to the journal."""
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    @property
+    def journaling(self):
+        """Whether edits are being logged to a journal."""
+        return self._journal is not None
+
+    def attach_storage(self, storage, key):
+        """Write every stop edit to a storage backend, such as sqlstore.SqliteStorage, as it happens.
+
+        Saving the map also writes the whole map to the storage, as well as exporting the GeoJSON file.
+        """
+        self._storage = storage
+        self._storage_key = key
+
+    @property
+    def persists_edits(self):
+        """Whether each edit is saved as it is made, by a journal or a storage backend."""
+        return self._journal is not None or self._storage is not None
+
+    def enable_tiles(self, directory=None):
+        """Also publish the web map as tiles each time the map is saved, rewriting only the tiles with changed stops.
+
+        The tiles go in directory, which defaults to a folder next to the map file. Every tile is written on the next
+        save, in case any are left over from before.
+        """
+        if directory is None:
+            directory = os.path.splitext(self._data['path'])[0] + '_tiles'
+        self._tiles_dir = directory
+        self._dirty_tiles = None
+
+    def _take_dirty_tiles(self):
+        """Return the tiles changed since this was last called, or None if every tile needs writing."""
+        dirty = self._dirty_tiles
+        self._dirty_tiles = set()
+        return dirty
+
+    @property
+    def version(self):
+        """Number that goes up with every change to a stop.
+
+        It starts from the time the map was loaded in milliseconds, so it keeps going up across restarts of the bot.
+        """
+        return self._version
+
+    def changes_since(self, version):
+        """Return the stop changes made after a version, oldest first, or None if they are too old to still be kept.
+
+        Each change is a dictionary with the version, the op, the stop key and the stop as it is published for the web
+        map, which for removed stops is how it was before it was removed. Bulk edits, such as the daily reset, leave a
+        single change with the op 'reload' in place of the changes before it, so None is also returned across one.
+        """
+        if version == self._version:
+            return []
+        if not self._changes or version < self._changes[0]['version'] - 1 or version > self._version:
+            return None
+        changes = [change for change in self._changes if change['version'] > version]
+        if changes[0]['op'] == 'reload':
+            return None
+        return changes
+
+    def add_listener(self, listener):
+        """Call listener with each stop change as it is made, in the form returned by changes_since.
+
+        Listeners are called with None if the map is unloaded, after which they won't get any more changes.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Stop calling a listener added with add_listener."""
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def unload(self):
+        """Tell the listeners the map is being unloaded and forget them, so they can follow the map once it's reloaded."""
+        listeners = self._listeners
+        self._listeners = []
+        for listener in listeners:
+            listener(None)
+
+    @contextlib.contextmanager
+    def _bulk_edit(self):
+        """Make many stop edits as one, such as a reset or an import.
+
+        The edits aren't journaled or passed on to the storage backend, so the map should be saved afterwards. Rather
+        than a change for each stop, clients get a single reload change once the edits are done, telling them to fetch
+        the whole map again.
+        """
+        version = self._version
+        self._journal_paused = True
+        try:
+            yield
+        finally:
+            self._journal_paused = False
+            if self._version != version:
+                self._version += 1
+                change = {'version': self._version, 'op': 'reload'}
+                self._changes.clear()
+                self._changes.append(change)
+                for listener in self._listeners:
+                    listener(change)
+
+    def _record(self, op, stop):
+        """Note a stop edit for clients and tiles, then pass it on to the storage backend and journal, if there are any."""
+        self._version += 1
+        if self._tiles_dir is not None and self._dirty_tiles is not None:
+            self._dirty_tiles.add(_tile(*stop.lat_long(), zoom=TILE_ZOOM))
+        if self._journal_paused:
+            return
+        change = {'version': self._version, 'op': op, 'stop': stop.key(), 'feature': _publish_feature(stop._data)}
+        self._changes.append(change)
+        for listener in self._listeners:
+            listener(change)
+        if self._storage is not None:
+            self._storage.record(self._storage_key, op, stop, self._version)
+        if self._journal is None:
+            return
+        self._journal_seq += 1
+        record = {'seq': self._journal_seq, 'op': op, 'stop': stop.key()}
+        if op == 'add_stop':
+            record['feature'] = stop._data
+        elif op != 'remove_stop':
+            record['properties'] = stop.properties
+        self._journal.write(json.dumps(record) + '\n')
+        self._journal.flush()
+
+    def replay_journal(self, filename):
+        """Apply the edits in a journal that are newer than the map file."""
+        try:
+            file = open(filename)
+        except FileNotFoundError:
+            return
+        stops = {stop.key(): stop for stop in self}
+        with file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # A crash part way through writing the last record
+                    break
+                if record['seq'] <= self._journal_seq:
+                    continue
+                self._journal_seq = record['seq']
+                key = tuple(record['stop'])
+                if record['op'] == 'add_stop':
+                    stops[key] = self.add_stop(record['feature'])
+                elif key not in stops:
+                    continue
+                elif record['op'] == 'remove_stop':
+                    self.remove_stop(stops.pop(key))
+                else:
+                    stop = stops[key]
+                    self._unindex_stop_names(stop)
+                    stop.properties = record['properties']
+                    self._index_stop_names(stop)
+                    if stop.properties.get('Category') == 'Shadow':
+                        self._track_shadow(stop)
+
+    def _compacted(self, journal_seq):
+        """Empty the journal once the map has been saved, unless edits were made after the saved snapshot."""
+        if self._journal is not None and self._journal_seq == journal_seq:
+            self._journal.seek(0)
+            self._journal.truncate()
+
     def save(self, filename=None):
-        """Save the map."""
+        """Save the map.
+
+        The map is written to a temporary file which is then renamed over the old one, so the web map never reads a
+        half written file.
+        """
         if filename is None:
             filename = self._data['path']
-        super().save(filename)
+        self._dirty_since = None
+        self._unpublished_since = None
+        if self._journal_seq:
+            self._data['journal_seq'] = self._journal_seq
+        self._saves_started += 1
+        with metrics.timer('pokemap_save_seconds', guild=self.guild, mode='sync'):
+            self._write_save(self._saves_started, filename, self._data, self._take_dirty_tiles(), self._version)
+        self._compacted(self._journal_seq)
+
+    def _write_save(self, number, filename, data, dirty_tiles, version=None, publish_only=False):
+        """Write a save of the map, waiting for any other save being written, on whichever thread it is called from.
+
+        Saves are numbered when their data is taken, and a save is skipped if a later one has already been written, so
+        a save running on an executor can't replace a newer save made by save or flush in the meantime. With
+        publish_only, only the files read by the web map are written, along with the GeoJSON export of maps kept in a
+        storage backend. The version the data was taken at lets the storage keep edits made since. Returns whether the
+        save was written.
+        """
+        with self._write_lock:
+            if number < self._saves_written:
+                return False
+            if publish_only:
+                if self._storage is not None:
+                    _write_map(filename, data)
+                _publish_map(published_path(filename), data)
+                if self._tiles_dir is not None:
+                    _publish_tiles(self._tiles_dir, data, dirty_tiles)
+            else:
+                _save_map(filename, data, self._storage, self._storage_key, self._tiles_dir, dirty_tiles, version)
+            self._saves_written = number
+            return True
+
+    def publish(self, filename=None):
+        """Write the slimmed down copy of the map read by the web map, along with compressed copies of it.
+
+        This is also done by every save, so is only needed to publish a map without saving it.
+        """
+        if filename is None:
+            filename = published_path(self._data['path'])
+        _publish_map(filename, self._data)
+        if self._tiles_dir is not None:
+            _publish_tiles(self._tiles_dir, self._data, self._take_dirty_tiles())
+
+    def snapshot(self):
+        """Return a copy of the map data that later edits won't change, for saving in the background.
+
+        Only the parts of each feature that stops edit in place are copied, the geometry is shared.
+        """
+        data = dict(self._data)
+        features = []
+        for featuredict in self._data["features"]:
+            feature = dict(featuredict)
+            feature['properties'] = properties = dict(featuredict['properties'])
+            if 'Nicknames' in properties:
+                properties['Nicknames'] = list(properties['Nicknames'])
+            features.append(feature)
+        data["features"] = features
+        if self._journal_seq:
+            data['journal_seq'] = self._journal_seq
+        return data
+
+    async def save_async(self, filename=None, executor=None):
+        """Save the map without blocking the event loop.
+
+        A snapshot is taken straight away and then encoded and written on an executor thread. Saves of the same map
+        are written one at a time in the order they were requested, so an older snapshot can never replace a newer one.
+        """
+        if filename is None:
+            filename = self._data['path']
+        snapshot = self.snapshot()
+        self._dirty_since = None
+        self._unpublished_since = None
+        if await self._write_snapshot(filename, snapshot, executor, 'async'):
+            self._compacted(snapshot.get('journal_seq', 0))
+
+    async def publish_async(self, filename=None, executor=None):
+        """Write just the files read by the web map without blocking the event loop, leaving the full save for later.
+
+        Maps that save each edit as it is made only need a full save every so often, this keeps the web map up to date
+        in between. Maps kept in a storage backend also export their GeoJSON file, without rewriting the storage.
+        """
+        if filename is None:
+            filename = self._data['path']
+        snapshot = self.snapshot()
+        self._unpublished_since = None
+        await self._write_snapshot(filename, snapshot, executor, 'publish', publish_only=True)
+
+    async def _write_snapshot(self, filename, snapshot, executor, mode, publish_only=False):
+        """Write a snapshot on an executor thread after any earlier background saves, returning whether it was written.
+
+        This must be called straight after taking the snapshot, so the map version still matches it.
+        """
+        dirty_tiles = self._take_dirty_tiles()
+        version = self._version
+        self._saves_started += 1
+        number = self._saves_started
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        async with self._save_lock:
+            try:
+                with metrics.timer('pokemap_save_seconds', guild=self.guild, mode=mode):
+                    written = await asyncio.get_event_loop().run_in_executor(executor, self._write_save, number, filename,
+                                                                             snapshot, dirty_tiles, version, publish_only)
+            except Exception:
+                self._dirty_tiles = None
+                self.request_save()
+                raise
+        if not written:  # A newer save got there first, but its tiles didn't include the ones this save took
+            self._dirty_tiles = None
+            self.request_save()
+        return written
+
+    def request_save(self):
+        """Mark the map as changed so the next flush saves and publishes it, coalescing changes made in the meantime."""
+        now = time.monotonic()
+        if self._dirty_since is None:
+            self._dirty_since = now
+        if self._unpublished_since is None:
+            self._unpublished_since = now
+
+    @property
+    def dirty(self):
+        """Whether the map has changes that haven't been saved yet."""
+        return self._dirty_since is not None
+
+    def flush(self, delay=0):
+        """Save the map if it has been changed for at least delay seconds. Returns True if the map was saved."""
+        if self._dirty_since is not None and time.monotonic() - self._dirty_since >= delay:
+            self.save()
+            return True
+        return False
+
+    async def flush_async(self, delay=0, executor=None, publish_delay=None):
+        """Save the map in the background if it has been changed for at least delay seconds.
+
+        If it isn't due a save yet but has been changed for at least publish_delay seconds, just the files read by the
+        web map are written instead.
+        """
+        now = time.monotonic()
+        if self._dirty_since is not None and now - self._dirty_since >= delay:
+            await self.save_async(executor=executor)
+            return True
+        if publish_delay is not None and self._unpublished_since is not None and now - self._unpublished_since >= publish_delay:
+            await self.publish_async(executor=executor)
+        return False
 
 
 # Custom functions
-def load(filepath=None, data=None, **kwargs):
-    """Modification of pygeoj.load to work with the ResearchMap class."""
-    return ResearchMap(filepath, data, **kwargs)
+def _normalize_name(name):
+    """Normalize a stop name or nickname into the form used by the lookup index."""
+    return name.replace('’', "'").title()
+
+
+def _stop_keys(properties):
+    """Return the set of index keys a stop can be found by."""
+    keys = {_normalize_name(properties['Stop Name'])}
+    for nickname in properties.get('Nicknames', []):
+        keys.add(_normalize_name(nickname))
+    return keys
+
+
+def _publish_tiles(directory, data, dirty=None):
+    """Write the web map tiles affected by changes to the stop tiles in dirty, or every tile if dirty is None.
+
+    Stop tiles are at TILE_ZOOM and hold the same features as the published map. Each tile at a zoom in CLUSTER_ZOOMS
+    holds one point per cell and map layer, placed at the middle of the stops it stands for and with their count.
+    Tiles that no longer have any stops are deleted. A meta.json with the map location and tile zooms is also written.
+    """
+    published = publish_data(data)
+    stop_tiles = {}
+    for feature in published['features']:
+        long, lat = feature['geometry']['coordinates']
+        stop_tiles.setdefault(_tile(lat, long, TILE_ZOOM), []).append(feature)
+    if dirty is None:
+        dirty = set(stop_tiles) | set(_existing_tiles(directory, TILE_ZOOM))
+    for x, y in dirty:
+        _write_tile(directory, TILE_ZOOM, x, y, stop_tiles.get((x, y), []))
+    for zoom in CLUSTER_ZOOMS:
+        shift = TILE_ZOOM - zoom
+        for x, y in {(x >> shift, y >> shift) for x, y in dirty}:
+            clusters = {}
+            for child_x in range(x << shift, (x + 1) << shift):
+                for child_y in range(y << shift, (y + 1) << shift):
+                    for feature in stop_tiles.get((child_x, child_y), []):
+                        long, lat = feature['geometry']['coordinates']
+                        key = (_tile(lat, long, zoom + CLUSTER_DEPTH), _layer_name(feature['properties']))
+                        clusters.setdefault(key, []).append((long, lat))
+            features = []
+            for (cell, layer), points in sorted(clusters.items()):
+                long = sum(point[0] for point in points) / len(points)
+                lat = sum(point[1] for point in points) / len(points)
+                features.append({'type': 'Feature',
+                                 'geometry': {'type': 'Point', 'coordinates': [round(long, PUBLISH_PRECISION), round(lat, PUBLISH_PRECISION)]},
+                                 'properties': {'Layer': layer, 'Count': len(points)}})
+            _write_tile(directory, zoom, x, y, features)
+    meta = {'tile_zoom': TILE_ZOOM, 'cluster_zooms': list(CLUSTER_ZOOMS)}
+    for name in ('loc', 'bbox'):
+        if name in published:
+            meta[name] = published[name]
+    _write_atomic(os.path.join(directory, 'meta.json'), lambda file: json.dump(meta, file))
+
+
+def _write_tile(directory, zoom, x, y, features):
+    """Write a tile's features, or delete the tile if there are none."""
+    filename = os.path.join(directory, str(zoom), str(x), str(y) + '.json')
+    if not features:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    collection = {'type': 'FeatureCollection', 'features': features}
+    _write_atomic(filename, lambda file: json.dump(collection, file, separators=(',', ':')))
+
+
+def _existing_tiles(directory, zoom):
+    """Return the tiles already written at a zoom level."""
+    tiles = []
+    zoom_dir = os.path.join(directory, str(zoom))
+    if not os.path.isdir(zoom_dir):
+        return tiles
+    for x in os.listdir(zoom_dir):
+        for name in os.listdir(os.path.join(zoom_dir, x)):
+            if name.endswith('.json'):
+                tiles.append((int(x), int(name[:-len('.json')])))
+    return tiles
+
+
+def _tile(lat, long, zoom):
+    """Return the x and y of the web map tile containing a point."""
+    count = 2 ** zoom
+    x = int((long + 180) / 360 * count)
+    y = int((1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * count)
+    return min(max(x, 0), count - 1), min(max(y, 0), count - 1)
+
+
+def _layer_name(properties):
+    """Return the name of the web map layer a stop is shown in, matching onEachFeature in index.html."""
+    if properties.get('Category') == 'Shadow':
+        return 'Shadow'
+    if not properties.get('Reward'):
+        return 'Unreported'
+    if properties.get('Category') == 'Encounter':
+        return properties['Reward']
+    return properties.get('Category', 'Unreported')
+
+
+def _write_atomic(filename, write, mode='w'):
+    """Write a file by calling write on a temporary file next to it and then renaming it into place.
+
+    The temporary file is named after the process and thread, so writes of the same file from different threads
+    can't mix, while it is still created with the usual permissions so the web server can read it.
+    """
+    temp_name = filename + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+    try:
+        with open(temp_name, mode) as file:
+            write(file)
+        os.replace(temp_name, filename)
+    except BaseException:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+
+class MapCache:
+    """Least recently used cache of maps, keyed by server, that loads maps on first use and evicts idle ones.
+
+    Maps are loaded by calling loader with the key. When more than max_maps maps or max_stops stops in total are
+    loaded, the least recently used maps are saved and dropped until the cache is back within budget, and on_evict, if
+    given, is called with the key and map of each one dropped.
+
+    While an event loop is running, evicted maps are saved in the background. A map that is used again before its save
+    has finished is put back in the cache rather than loaded again from files the save is still writing.
+    """
+
+    def __init__(self, loader, max_maps=None, max_stops=None, on_evict=None):
+        """Initialize an empty cache."""
+        self._loader = loader
+        self._on_evict = on_evict
+        self._maps = collections.OrderedDict()
+        self._saving = {}
+        self.max_maps = max_maps
+        self.max_stops = max_stops
+
+    def __getitem__(self, key):
+        """Return the map for a key, loading it if it isn't loaded."""
+        if key in self._maps:
+            self._maps.move_to_end(key)
+            return self._maps[key]
+        taskmap = self._saving.pop(key, None)
+        if taskmap is None:
+            taskmap = self._loader(key)
+        self[key] = taskmap
+        return taskmap
+
+    def __setitem__(self, key, taskmap):
+        """Add a loaded map to the cache."""
+        self._maps[key] = taskmap
+        self._maps.move_to_end(key)
+        self._evict()
+
+    def __contains__(self, key):
+        """Check if the map for a key is loaded."""
+        return key in self._maps
+
+    def __len__(self):
+        """Return the number of loaded maps."""
+        return len(self._maps)
+
+    def get(self, key, default=None):
+        """Return the map for a key if it is loaded, without loading it or marking it as used."""
+        return self._maps.get(key, default)
+
+    def keys(self):
+        """Return the keys of the loaded maps."""
+        return list(self._maps.keys())
+
+    def values(self):
+        """Return the loaded maps."""
+        return list(self._maps.values())
+
+    def items(self):
+        """Return (key, map) pairs for the loaded maps."""
+        return list(self._maps.items())
+
+    def evict(self, key):
+        """Drop a loaded map, saving it in the background if an event loop is running or straight away if not."""
+        taskmap = self._maps.pop(key)
+        taskmap.unload()
+        if self._on_evict is not None:
+            self._on_evict(key, taskmap)
+        if asyncio.get_event_loop().is_running():
+            self._saving[key] = taskmap
+            asyncio.ensure_future(self._save_evicted(key, taskmap))
+            return
+        try:
+            taskmap.flush()
+        except ValueError:
+            pass
+        taskmap.close_journal()
+
+    async def _save_evicted(self, key, taskmap):
+        """Save an evicted map on an executor thread, then close its journal unless it has been put back in the cache."""
+        try:
+            await taskmap.flush_async()
+        except ValueError:
+            pass
+        finally:
+            if self._saving.get(key) is taskmap:
+                del self._saving[key]
+            if self._maps.get(key) is not taskmap:
+                taskmap.close_journal()
+
+    def _evict(self):
+        """Evict the least recently used maps until the cache is within its budget, always keeping the newest map."""
+        while len(self._maps) > 1:
+            over_maps = self.max_maps is not None and len(self._maps) > self.max_maps
+            over_stops = self.max_stops is not None and sum(len(taskmap) for taskmap in self._maps.values()) > self.max_stops
+            if not (over_maps or over_stops):
+                break
+            self.evict(next(iter(self._maps)))
+
+
+class MapScheduler:
+    """Min-heap of the unix times at which each map next needs attention, such as its midnight reset.
+
+    Each key has at most one deadline; rescheduling a key leaves its old heap entry behind to be skipped when popped.
+    """
+
+    def __init__(self):
+        """Initialize an empty schedule."""
+        self._heap = []
+        self._deadlines = {}
+        self._counter = itertools.count()
+
+    def schedule(self, key, deadline):
+        """Set the time a key is next due, replacing any earlier deadline for it."""
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, next(self._counter), key))
+
+    def remove(self, key):
+        """Remove a key from the schedule."""
+        self._deadlines.pop(key, None)
+
+    def next_deadline(self):
+        """Return the earliest deadline, or None if nothing is scheduled."""
+        while self._heap:
+            deadline, _, key = self._heap[0]
+            if self._deadlines.get(key) == deadline:
+                return deadline
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now=None):
+        """Remove and return the keys whose deadlines have passed, earliest first."""
+        if now is None:
+            now = time.time()
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, _, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+
+class ReportSession:
+    """A stop someone has reported, waiting for them to report its task in their next message."""
+
+    __slots__ = ('stop', 'message', 'expires')
+
+    def __init__(self, stop, message, expires):
+        """Initialize the session."""
+        self.stop = stop
+        self.message = message
+        self.expires = expires
+
+
+class SessionStore:
+    """Report sessions keyed by guild, channel and author, that expire after ttl seconds.
+
+    Sessions are kept in the order they were started, which with a fixed ttl is also the order they expire in, so
+    expired sessions are dropped from the front as new ones start. At most max_sessions are kept.
+    """
+
+    def __init__(self, ttl, max_sessions=None):
+        """Initialize an empty store."""
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = collections.OrderedDict()
+
+    def start(self, key, stop, message, now=None):
+        """Start a session, replacing any the key already had."""
+        if now is None:
+            now = time.time()
+        self._sessions.pop(key, None)
+        self._sessions[key] = ReportSession(stop, message, now + self.ttl)
+        self.expire(now)
+        while self.max_sessions is not None and len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def __contains__(self, key):
+        """Check if a key has a session that hasn't expired."""
+        session = self._sessions.get(key)
+        return session is not None and session.expires > time.time()
+
+    def __len__(self):
+        """Return the number of sessions kept, including expired ones not yet dropped."""
+        return len(self._sessions)
+
+    def pop(self, key):
+        """Remove and return a key's session, or None if it has none or it has expired."""
+        session = self._sessions.pop(key, None)
+        if session is None or session.expires <= time.time():
+            return None
+        return session
+
+    def discard(self, key):
+        """End a key's session if it has one."""
+        self._sessions.pop(key, None)
+
+    def discard_guild(self, guild):
+        """End every session in a guild."""
+        for key in [key for key in self._sessions if key[0] == guild]:
+            del self._sessions[key]
+
+    def expire(self, now=None):
+        """Drop the sessions that have expired."""
+        if now is None:
+            now = time.time()
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.expires > now:
+                break
+            self._sessions.popitem(last=False)
+
+
+def _save_map(filename, data, storage=None, key=None, tiles_dir=None, dirty_tiles=None, version=None):
+    """Write map data to its storage backend, if it has one, and to a GeoJSON file, then publish it for the web map.
+
+    The version is the map version the data was taken at, so the storage backend can keep edits recorded since.
+    """
+    if storage is not None:
+        storage.save_map(key, data, version)
+    _write_map(filename, data)
+    _publish_map(published_path(filename), data)
+    if tiles_dir is not None:
+        _publish_tiles(tiles_dir, data, dirty_tiles)
+
+
+def published_path(filepath):
+    """Return where the web map copy of the map saved at filepath is published."""
+    return os.path.splitext(filepath)[0] + '.min.json'
+
+
+def publish_data(data):
+    """Return the parts of map data that the web map renders, with rounded coordinates."""
+    features = [_publish_feature(featuredict) for featuredict in data['features']]
+    published = {'type': 'FeatureCollection', 'features': features}
+    if features:
+        published['bbox'] = [round(value, PUBLISH_PRECISION) for value in _features_bbox(features)]
+    if 'loc' in data:
+        published['loc'] = data['loc']
+    return published
+
+
+def _publish_feature(featuredict):
+    """Return the parts of a stop that the web map renders, with rounded coordinates."""
+    properties = featuredict['properties']
+    long, lat = featuredict['geometry']['coordinates'][:2]
+    return {'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [round(long, PUBLISH_PRECISION), round(lat, PUBLISH_PRECISION)]},
+            'properties': {name: properties[name] for name in PUBLISHED_PROPERTIES if properties.get(name)}}
+
+
+def _publish_map(filename, data):
+    """Write the web map copy of map data as compact JSON, with .gz and, if brotli is installed, .br copies."""
+    encoded = json.dumps(publish_data(data), separators=(',', ':')).encode('utf-8')
+    _write_atomic(filename, lambda file: file.write(encoded), 'wb')
+    _write_atomic(filename + '.gz', lambda file: file.write(gzip.compress(encoded, 9)), 'wb')
+    if brotli is not None:
+        _write_atomic(filename + '.br', lambda file: file.write(brotli.compress(encoded)), 'wb')
+
+
+def _write_map(filename, data):
+    """Update the bounding box of map data and write it to a file."""
+    if data["features"]:
+        data["bbox"] = _features_bbox(data["features"])
+    _write_atomic(filename, lambda file: json.dump(data, file))
+
+
+def _features_bbox(features):
+    """Return the bounding box around a list of geojson features."""
+    xmins, ymins, xmaxs, ymaxs = [], [], [], []
+    for featuredict in features:
+        geometry = featuredict['geometry']
+        if geometry is None or geometry.get('type') == 'Null':
+            continue
+        if geometry['type'] == 'Point':
+            x, y = geometry['coordinates'][:2]
+            bbox = [x, y, x, y]
+        else:
+            bbox = pygeoj.Geometry(geometry).bbox
+        xmins.append(bbox[0])
+        ymins.append(bbox[1])
+        xmaxs.append(bbox[2])
+        ymaxs.append(bbox[3])
+    return [min(xmins), min(ymins), max(xmaxs), max(ymaxs)]
+
+
+def _grid_cell(lat, long):
+    """Return the spatial index cell containing a point."""
+    return (math.floor(lat / GRID_SIZE), math.floor(long / GRID_SIZE))
+
+
+def distance(lat1, long1, lat2, long2):
+    """Return the great circle distance between two points in meters."""
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(long2 - long1) / 2) ** 2
+    return 2 * EARTH_RADIUS * math.asin(min(1, math.sqrt(a)))
+
+
+def _bigrams(text):
+    """Return the number of times each two character substring appears in a string."""
+    counts = {}
+    for i in range(len(text) - 1):
+        counts[text[i:i + 2]] = counts.get(text[i:i + 2], 0) + 1
+    return counts
+
+
+def _trigrams(text):
+    """Return the set of three character substrings of a string."""
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def load(filepath=None, data=None, journal=False, **kwargs):
+    """Modification of pygeoj.load to work with the ResearchMap class.
+
+    Edits in a journal next to the file are replayed, and if journal is True new edits are logged to it.
+    """
+    taskmap = ResearchMap(filepath, data, **kwargs)
+    if filepath is not None:
+        taskmap.replay_journal(filepath + '.journal')
+        if journal:
+            taskmap.enable_journal(filepath + '.journal')
+    return taskmap
+
+
+def read_stops(text, filename=''):
+    """Read (name, lat, long) rows for import_stops from the text of a CSV, GeoJSON or Ingress portal export.
+
+    CSV files are read a row at a time. They can have a header naming the name, latitude and longitude columns, or
+    otherwise have them in that order. JSON files can be GeoJSON, or a list or dictionary of portals with title, lat
+    and lng fields as made by IITC portal export plugins. The values are passed on as found, so import_stops can
+    count the rows it can't use. Files that can't be read at all raise ValueError.
+    """
+    stripped = text.lstrip()
+    if filename.lower().endswith(('.json', '.geojson')) or stripped.startswith(('{', '[')):
+        for row in _json_stop_rows(json.loads(text)):
+            yield row
+        return
+    reader = csv.reader(io.StringIO(text))
+    columns = (0, 1, 2)
+    try:
+        for i, row in enumerate(reader):
+            if not row:
+                continue
+            if i == 0:
+                header = [cell.strip().lower() for cell in row]
+                found = [_find_column(header, names) for names in (('name', 'stop name', 'title', 'portal'), ('lat', 'latitude'), ('long', 'lng', 'lon', 'longitude'))]
+                if None not in found:
+                    columns = found
+                    continue
+            if len(row) <= max(columns):
+                yield None, None, None
+            else:
+                yield row[columns[0]], row[columns[1]], row[columns[2]]
+    except csv.Error as e:   # Such as a field over the size limit, from a file that isn't really CSV
+        raise ValueError(str(e)) from e
+
+
+def _find_column(header, names):
+    """Return the index of the first column with one of the names, or None."""
+    for name in names:
+        if name in header:
+            return header.index(name)
+    return None
+
+
+def _json_stop_rows(data):
+    """Yield (name, lat, long) rows from GeoJSON or a portal export."""
+    if isinstance(data, dict) and data.get('type') == 'FeatureCollection':
+        for feature in data.get('features', []):
+            properties = feature.get('properties') or {}
+            name = properties.get('Stop Name', properties.get('name', properties.get('title')))
+            geometry = feature.get('geometry') or {}
+            if geometry.get('type') == 'Point':
+                yield name, geometry['coordinates'][1], geometry['coordinates'][0]
+            else:
+                yield name, None, None
+        return
+    portals = data.values() if isinstance(data, dict) else data
+    for portal in portals:
+        if not isinstance(portal, dict):
+            yield None, None, None
+            continue
+        lat = portal.get('lat', portal.get('latE6', 0) / 1e6 if 'latE6' in portal else None)
+        long = portal.get('lng', portal.get('lngE6', 0) / 1e6 if 'lngE6' in portal else None)
+        yield portal.get('title', portal.get('name')), lat, long
+
+
+def read_tasklist(filepath='tasklist.jsonl', legacy_path=None):
+    """Read a tasklist file, falling back to the pickled tasklist at legacy_path and then to an empty tasklist."""
+    try:
+        return _parse_tasklist(filepath)
+    except FileNotFoundError:
+        pass
+    try:
+        with open(legacy_path, 'rb') as file_input:
+            return pickle.load(file_input)
+    except (FileNotFoundError, TypeError):
+        return Tasklist()
+
+
+def _parse_tasklist(filepath):
+    """Read a tasklist file written by Tasklist.save, applying the records appended to it since.
+
+    A file without a valid header raises TasklistFormatError, while records that can't be applied are reported and
+    skipped so that one bad record doesn't lose the rest of the tasklist.
+    """
+    tasklist = Tasklist()
+    with open(filepath) as file:
+        try:
+            header = json.loads(file.readline())
+        except ValueError:
+            raise TasklistFormatError(filepath, 'missing header')
+        if not isinstance(header, dict) or header.get('format') != 'tasklist':
+            raise TasklistFormatError(filepath, 'missing header')
+        if header.get('version') != TASKLIST_VERSION:
+            raise TasklistFormatError(filepath, 'unsupported version ' + str(header.get('version')))
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:  # A crash part way through writing the last record
+                break
+            op = record.get('op') if isinstance(record, dict) else None
+            if op in ('add', 'update'):
+                task = record.get('task')
+                if isinstance(task, dict) and 'shiny' in task:
+                    task['shiny'] = _to_bool(task['shiny'])
+                if not isinstance(task, dict) or any(not isinstance(task.get(field), kind) for field, kind in TASK_FIELDS.items()):
+                    print('Skipping bad task in ' + filepath + ': ' + line.strip())
+                    continue
+                task = Task.from_dict(task)
+            if op == 'add':
+                tasklist.tasks.append(task)
+            elif op in ('update', 'delete') and isinstance(record.get('index'), int) and 0 <= record['index'] < len(tasklist.tasks):
+                if op == 'update':
+                    tasklist.tasks[record['index']] = task
+                else:
+                    del tasklist.tasks[record['index']]
+            else:
+                print('Skipping bad record in ' + filepath + ': ' + line.strip())
+    tasklist._build_index()
+    return tasklist
+
+
+def load_tasklist(filepath='tasklist.jsonl', legacy_path=None):
+    """Load a tasklist and log further changes to its file, compacting the file first.
+
+    If filepath doesn't exist yet the tasklist is migrated from the pickle at legacy_path, if there is one.
+    """
+    tasklist = read_tasklist(filepath, legacy_path)
+    tasklist.save(filepath)
+    tasklist.open_log(filepath)
+    return tasklist
+
+
+def load_timed(filepath):
+    """Load a map and reset its old stops, returning the map, whether any stops were reset and the seconds it took."""
+    start = time.perf_counter()
+    taskmap = load(filepath)
+    stops_reset = taskmap.reset_old()
+    return taskmap, stops_reset, time.perf_counter() - start
 
 
 def new():
@@ -339,18 +1821,76 @@ def new():
     return ResearchMap()
 
 
-def match_pokemon(name):
-    """Find the closest pokemon to a string."""
-    with open('pokemon.txt') as file:
-        if name.title() + '\n' in file.read():
+class PokemonNames:
+    """Registry of known pokemon names, read once from a text file with one name per line."""
+
+    def __init__(self, filename='pokemon.txt'):
+        """Load the names and bucket them by length for fuzzy matching."""
+        with open(filename) as file:
+            self.names = [line.strip('\n') for line in file if line.strip('\n')]
+        self._exact = set(self.names)
+        self._lower = {line.lower() for line in self.names}
+        self._by_length = {}
+        for position, line in enumerate(self.names):
+            self._by_length.setdefault(len(line), []).append((position, line))
+
+    def __contains__(self, name):
+        """Check if a string is a known pokemon name, ignoring case."""
+        return name.lower() in self._lower
+
+    def match(self, name):
+        """Find the closest pokemon to a string.
+
+        A fuzz ratio above 80 needs the lengths of the two strings to be within a factor of about 1.5 of each other,
+        so only names in that length range are scored, in file order so the first good match still wins.
+        """
+        if name.title() in self._exact:
             return name
-    with open('pokemon.txt') as file:
-        line = file.readline().strip('\n')
-        while line:
+        length = len(name)
+        candidates = []
+        for line_length in range(int(0.67 * length), int(1.5 * length) + 1):
+            candidates.extend(self._by_length.get(line_length, []))
+        candidates.sort()
+        for position, line in candidates:
             if fuzz.ratio(name.title(), line) > 80:
                 return line
-            line = file.readline().strip('\n')
-    return None
+        return None
+
+    def match_many(self, names):
+        """Match a list of strings to pokemon, returning None for any that don't match."""
+        matches = {}
+        for name in names:
+            if name not in matches:
+                matches[name] = self.match(name)
+        return [matches[name] for name in names]
+
+
+_pokemon_names = None
+
+
+def pokemon_names():
+    """Return the pokemon name registry, loading it on first use."""
+    global _pokemon_names
+    if _pokemon_names is None:
+        _pokemon_names = PokemonNames()
+    return _pokemon_names
+
+
+def match_pokemon(name):
+    """Find the closest pokemon to a string."""
+    return pokemon_names().match(name)
+
+
+def match_many(names):
+    """Find the closest pokemon to each string in a list."""
+    return pokemon_names().match_many(names)
+
+
+def _to_bool(value):
+    """Convert a flag that may have been given as a string, such as the shiny argument of a command, to a bool."""
+    if isinstance(value, str):
+        return value.strip().lower() in ('true', 'yes', 'y', '1', 'shiny')
+    return bool(value)
 
 
 # Custom Exceptions
@@ -398,6 +1938,14 @@ class StopNotFound(PokemapException):
         self.message = "No stop found with the given string."
 
 
+class TasklistFormatError(PokemapException):
+    """Exception for when a tasklist file can't be read."""
+
+    def __init__(self, filepath, reason):
+        """Add message based on context of error."""
+        self.message = "Could not read the tasklist at " + filepath + ": " + reason + "."
+
+
 class TaskNotFound(PokemapException):
     """Exception for when task not found with the given search string."""
 
@@ -443,6 +1991,25 @@ class InvalidTimezone(PokemapException):
         self.message = "Invalid time zone string, choose one from https://stackoverflow.com/questions/13866926/is-there-a-list-of-pytz-timezones."
 
 
+class StopAlreadyExists(PokemapException):
+    """Exception for when a new stop is added on top of an existing one."""
+
+    def __init__(self, stop=None):
+        """Add message based on context of error."""
+        if stop is None:
+            self.message = "There is already a stop at this location."
+        else:
+            self.message = "There is already a stop at this location: " + stop.properties['Stop Name']
+
+
+class BoundsNotSet(PokemapException):
+    """Exception for when stops are imported into a map without a boundary."""
+
+    def __init__(self):
+        """Add message based on context of error."""
+        self.message = "This map doesn't have a boundary yet. Set one with setbounds before importing stops."
+
+
 class StopOutsideBoundary(PokemapException):
     """Exception for when a stop is added outside of the boundary."""
 
@@ -1,9 +1,16 @@
 """Discord bot for mapping out pokemon go research and other misc functions."""
+import aiohttp
 import asyncio
+import collections
+import concurrent.futures
+import os
 import pokemap
-import pickle
+import mapserver
+import metrics
+import sqlstore
 import discord
 import inspect
+import time
 from datetime import datetime
 from discord import Game
 from discord.ext.commands import Bot, has_permissions
@@ -13,25 +20,88 @@ import urllib.parse as urlparse
 # Setup Variables
 bot_prefix = ("?")   # Tells bot which prefix(or prefixes) to look for. Multiple prefixes can be specified in a tuple, however all help messages will use the first item for examples
 map_dir = '/var/www/html/maps/'  # Path the saved map, in geojson format. http://geojson.io/ can be used to create basic maps, or the bot can do it interactively
-task_path = 'tasklist.pkl'   # Location to save the tasklist to and load it from if the bot is restarted
+task_path = 'tasklist.jsonl'   # Location to save the tasklist to and load it from if the bot is restarted
+legacy_task_path = 'tasklist.pkl'   # Pickled tasklist from older versions, migrated to task_path if that doesn't exist yet
 map_url = 'http://robowillow.ddns.net'
 bot_game = "with maps at robowillow.net"
 maintainer_handle = '@mathmauney'
 maintainer_id = 200038656021364736
+save_delay = 5   # Seconds to wait after a map changes before saving it, so bursts of reports are written to disk once
+use_journal = False   # Log each edit to an append-only journal next to the map instead of rewriting the map after every burst of reports
+compact_interval = 600   # With the journal or storage_path on, seconds between folding edits back into a full save of the map. The web map is still updated save_delay seconds after changes
+rollover_spread = 300   # Midnight resets are spread over this many seconds so maps aren't all saved at once
+max_loaded_maps = 200   # Maps are loaded when first used, and the least recently used are saved and unloaded past this many
+max_loaded_stops = None   # Optional limit on the total stops in loaded maps, as a rough memory budget
+preload_maps = False   # Load every server's map in the background on startup instead of waiting for each to be used
+preload_workers = 4   # Number of threads used to load maps on startup. Parsing is pure Python so only one thread parses at a time, the threads keep the bot responsive and overlap reading files
+storage_path = None   # Optional SQLite database to keep maps and the tasklist in. Maps are still exported to map_dir for the website, and existing map files and the tasklist are copied in on first use
+use_tiles = False   # Also publish each map as tiles, so the web map only loads the stops on screen. Worth turning on for maps with thousands of stops
+max_near_radius = 1000   # Largest radius in meters the near command searches, so a huge radius can't tie up the bot walking the map
+web_port = None   # Port to serve maps and their latest changes over HTTP from the bot, so web clients can poll for changes. None turns this off
+web_host = '0.0.0.0'   # Address to serve maps on when web_port is set
+max_report_length = 300   # Messages longer than this per line are never treated as stop reports
+max_report_lines = 100   # Messages with more lines than this are never treated as a list of reports
+max_stop_words = 12   # Messages whose first line has more words than this are never treated as stop names
+report_session_ttl = 300   # Seconds the bot waits after someone names a stop for them to name its task in their next message
+max_report_sessions = 10000   # Limit on the reports waiting for a second message, the oldest are dropped past this
+metrics_path = None   # Optional file to write counters and latency histograms to in the Prometheus text format, for a node exporter textfile collector. They are also served at /metrics when web_port is set
+metrics_interval = 60   # Seconds between writes of metrics_path
 
 
 # Load In Saved Data
+def load_map(server_id):
+    """Load a server's map from map_dir, or create a new one if it has no map yet."""
+    map_path = map_dir + str(server_id) + '.json'
+    try:
+        if store is not None:
+            taskmap = store.load_map(server_id, map_path)
+        else:
+            taskmap = pokemap.load(map_path, journal=use_journal)
+        if taskmap.reset_old():
+            taskmap.request_save()
+        print('Map for ' + str(server_id) + ' successfully loaded, map time is: ' + taskmap.now().strftime("%Y.%m.%d.%H%M%S"))
+    except FileNotFoundError:
+        taskmap = pokemap.new()
+        if store is not None:
+            taskmap.attach_storage(store, server_id)
+            store.save_map(server_id, taskmap._data)
+        print('No map found at: ' + map_path + '. Creating new map now')
+    setup_map(server_id, taskmap)
+    return taskmap
+
+
+def setup_map(server_id, taskmap):
+    """Finish setting up a freshly loaded map."""
+    taskmap._data['path'] = map_dir + str(server_id) + '.json'
+    taskmap.guild = server_id
+    if use_journal and store is None and not taskmap.journaling:
+        taskmap.enable_journal()
+    if use_tiles and taskmap._tiles_dir is None:
+        taskmap.enable_tiles()
+        taskmap.request_save()
+    schedule_rollover(server_id, taskmap)
+    schedule_shadow_expiry(server_id, taskmap)
+
+
+def map_evicted(server_id, taskmap):
+    """Forget the report sessions of a map that has been unloaded, since their stops belong to the unloaded copy."""
+    report_sessions.discard_guild(server_id)
+
+
 # Initialize Map Object
-maps = {}
-prev_message_was_stop = {}
-prev_message_stop = {}
-prev_message = {}
+maps = pokemap.MapCache(load_map, max_loaded_maps, max_loaded_stops, map_evicted)
+report_sessions = pokemap.SessionStore(report_session_ttl, max_report_sessions)
+rollovers = pokemap.MapScheduler()
+shadow_expiries = pokemap.MapScheduler()
+timer_wakeup = asyncio.Event()
+report_filter_counts = collections.Counter()
 # Import the tasklist object or create new one
-try:
-    with open(task_path, 'rb') as file_input:
-        tasklist = pickle.load(file_input)
-except FileNotFoundError:
-    tasklist = pokemap.Tasklist()
+if storage_path is not None:
+    store = sqlstore.SqliteStorage(storage_path)
+    tasklist = store.load_tasklist(task_path, legacy_task_path)
+else:
+    store = None
+    tasklist = pokemap.load_tasklist(task_path, legacy_task_path)
 
 # Startup Bot Instance
 client = Bot(command_prefix=bot_prefix)
@@ -40,42 +110,58 @@ client = Bot(command_prefix=bot_prefix)
 # Sets the bots playing status
 @client.event
 async def on_ready():
-    """Take actions on login."""
+    """Take actions on login. Maps are loaded the first time each server uses them, unless preload_maps is set."""
     await client.change_presence(game=Game(name=bot_game))  # Sets the game presence
     print("Logged in as " + client.user.name)  # Logs sucessful login
-    for server in client.servers:
-        print(server.id)
-        map_path = map_dir + str(server.id) + '.json'
-        try:
-            taskmap = pokemap.load(map_path)
-            reset_bool = taskmap.reset_old()
-            if reset_bool:
-                taskmap.save(map_path)
-            print('Map successfully loaded, map time is: ' + taskmap.now().strftime("%Y.%m.%d.%H%M%S"))
-        except FileNotFoundError:
-            taskmap = pokemap.new()
-            print('No map found at: ' + map_path + '. Creating new map now')
-        taskmap._data['path'] = map_path
-        maps[server.id] = taskmap
-        prev_message_was_stop[server.id] = False
+    if preload_maps:
+        await load_all_maps([server.id for server in client.servers])
+
+
+async def load_all_maps(server_ids):
+    """Load the maps for many servers on worker threads, making each one available as soon as it is ready.
+
+    The threads keep the event loop free while maps load, but parsing and indexing hold the GIL, so this is no faster
+    than loading the maps one after another apart from overlapping file reads. A process pool wouldn't help much, as
+    the loaded maps would have to be pickled back to this process, which costs about as much as parsing them.
+    """
+    start = time.perf_counter()
+    server_ids = [server_id for server_id in server_ids if server_id not in maps and os.path.exists(map_dir + str(server_id) + '.json')]
+
+    async def load_one(server_id):
+        """Load one map on the executor."""
+        if store is not None:
+            result = await client.loop.run_in_executor(executor, store.load_timed, server_id, map_dir + str(server_id) + '.json')
+        else:
+            result = await client.loop.run_in_executor(executor, pokemap.load_timed, map_dir + str(server_id) + '.json')
+        return server_id, result
+
+    with concurrent.futures.ThreadPoolExecutor(preload_workers) as executor:
+        for future in asyncio.as_completed([load_one(server_id) for server_id in server_ids]):
+            try:
+                server_id, (taskmap, stops_reset, seconds) = await future
+            except Exception as e:
+                print('Failed to load a map: ' + repr(e))
+                continue
+            if server_id in maps:   # Already loaded on demand while waiting
+                continue
+            if stops_reset:
+                taskmap.request_save()
+            setup_map(server_id, taskmap)
+            maps[server_id] = taskmap
+            print('Loaded map for ' + str(server_id) + ' in ' + format(seconds, '.3f') + 's')
+    print('Loaded ' + str(len(server_ids)) + ' maps in ' + format(time.perf_counter() - start, '.3f') + 's')
 
 
 @client.event
 async def on_server_join(server):
     """Take actions on server join."""
     print(server.id)
-    map_path = map_dir + str(server.id) + '.json'
-    try:
-        taskmap = pokemap.load(map_path)
-        reset_bool = taskmap.reset_old()
-        if reset_bool:
-            taskmap.save(map_path)
-        print('Map successfully loaded, map time is: ' + taskmap.now().strftime("%Y.%m.%d.%H%M%S"))
-    except FileNotFoundError:
-        taskmap = pokemap.new()
-        print('No map found at: ' + map_path + '. Creating new map now')
-    taskmap._data['path'] = map_path
-    maps[server.id] = taskmap
+
+
+async def save_tasklist():
+    """Save the tasklist to the database, if there is one. Otherwise each change is already appended to task_path."""
+    if store is not None:
+        store.save_tasklist(tasklist)
 
 
 # Bot Command Definitions
@@ -156,12 +242,54 @@ async def addstop(ctx, *args):
         await client.say('Not enough arguments. Please give the stop a name and the latitude and longitude. Use the "' + bot_prefix[0] + 'help addstop" command for detailed instructions')
     try:
         taskmap.new_stop([long, lat], name)
-        taskmap.save()
+        taskmap.request_save()
         await client.say('Creating stop named: ' + name + ' at [' + str(lat) + ', ' + str(long) + '].')
     except pokemap.PokemapException as e:
         await client.say(e.message)
 
 
+@client.command(pass_context=True)
+@has_permissions(administrator=True)
+@pass_errors
+async def importstops(ctx):
+    """Add every stop in an attached CSV, GeoJSON or Ingress portal export file to the map, saving it once."""
+    taskmap = maps[ctx.message.server.id]
+    if not ctx.message.attachments:
+        await client.say('Attach a CSV, GeoJSON or portal export file to the command to import stops from it.')
+        return
+    attachment = ctx.message.attachments[0]
+    async with aiohttp.ClientSession() as session:
+        async with session.get(attachment['url']) as response:
+            data = await response.read()
+    try:
+        counts = taskmap.import_stops(pokemap.read_stops(data.decode('utf-8-sig'), attachment['filename']))
+    except ValueError:  # Including UnicodeDecodeError, for files that aren't text such as spreadsheets
+        await client.say('Could not read ' + attachment['filename'] + '.')
+        return
+    if counts['added']:
+        await taskmap.save_async()
+    await client.say('Added ' + str(counts['added']) + ' stops. Skipped ' + str(counts['duplicate']) + ' already on the map, ' +
+                     str(counts['outside']) + ' outside the boundary and ' + str(counts['invalid']) + ' without a name or location.')
+
+
+@client.command(pass_context=True)
+@pass_errors
+async def near(ctx, lat, long, radius=50):
+    """List the stops within radius meters (50 by default, max_near_radius at most) of a latitude and longitude."""
+    taskmap = maps[ctx.message.server.id]
+    radius = float(radius)
+    if not 0 <= radius <= max_near_radius:  # Also catches nan
+        radius = max_near_radius if radius > 0 else 0
+    found = taskmap.nearby(float(lat), float(long), radius)
+    if found == []:
+        await client.say('No stops found within ' + str(radius) + 'm.')
+    else:
+        lines = [stop.properties['Stop Name'] + ' (' + str(int(round(dist))) + 'm)' for dist, stop in found[:20]]
+        if len(found) > 20:
+            lines.append('...and ' + str(len(found) - 20) + ' more.')
+        await client.say('\n'.join(lines))
+
+
 @client.command(pass_context=True)
 async def settask(ctx, *args):
     """Set a task to a stop."""
@@ -175,11 +303,9 @@ async def settask(ctx, *args):
             stop_name = stop_name.title()
             stop = taskmap.find_stop(stop_name)
             task = tasklist.find_task(task_str)
-            stop.set_task(task)
-            if task_str.title() in task.rewards:
-                stop.properties['Icon'] = task_str.title()
+            stop.set_task(task, task_str)
             await client.say('Task set.')
-            taskmap.save()
+            taskmap.request_save()
         except pokemap.PokemapException as e:
             await client.say(e.message)
     else:
@@ -195,7 +321,7 @@ async def resetstop(ctx, *args):
     stop_name = stop_name
     stop = taskmap.find_stop(stop_name)
     stop.reset()
-    taskmap.save()
+    taskmap.request_save()
     await client.add_reaction(ctx.message, '👍')
 
 
@@ -204,7 +330,7 @@ async def resetstop(ctx, *args):
 async def addtask(reward, quest, shiny=False):
     """Add a task to a stop."""
     tasklist.add_task(pokemap.Task(reward, quest, shiny))
-    tasklist.save(task_path)
+    await save_tasklist()
     client.say('Task Added')
 
 
@@ -212,9 +338,10 @@ async def addtask(reward, quest, shiny=False):
 @pass_errors
 async def resettasklist():
     """Backup and reset the tasklist."""
-    backup_name = datetime.now().strftime("%Y.%m.%d.%H%M%S") + '_tasklist_backup.pkl'
-    tasklist.save(backup_name)
+    backup_name = datetime.now().strftime("%Y.%m.%d.%H%M%S") + '_tasklist_backup.jsonl'
+    await tasklist.save_async(backup_name)
     tasklist.clear()
+    await save_tasklist()
 
 
 @client.command(aliases=['tasklist'])
@@ -252,7 +379,7 @@ async def deletestop(ctx, *args):
     stop_str = ' '.join(args)
     stop = taskmap.find_stop(stop_str)
     taskmap.remove_stop(stop)
-    taskmap.save()
+    taskmap.request_save()
     await client.add_reaction(ctx.message, '👍')
 
 
@@ -262,7 +389,7 @@ async def deletetask(task_str):
     """Delete a task."""
     task = tasklist.find_task(task_str)
     tasklist.remove_task(task)
-    tasklist.save(task_path)
+    await save_tasklist()
 
 
 @client.command(pass_context=True)
@@ -272,7 +399,7 @@ async def nicknamestop(ctx, stop_name, nickname):
     taskmap = maps[ctx.message.server.id]
     stop = taskmap.find_stop(stop_name)
     stop.add_nickname(nickname)
-    taskmap.save()
+    taskmap.request_save()
     await client.add_reaction(ctx.message, '👍')
 
 
@@ -282,7 +409,7 @@ async def nicknametask(task_name, nickname):
     """Add a nickname to a task."""
     task = tasklist.find_task(task_name)
     task.add_nickname(nickname)
-    tasklist.save(task_path)
+    await save_tasklist()
     await client.add_reaction(ctx.message, '👍')
 
 
@@ -294,7 +421,7 @@ async def setlocation(ctx, lat, long):
     taskmap = maps[ctx.message.server.id]
     taskmap.set_location(float(lat), float(long))
     try:
-        taskmap.save()
+        await taskmap.save_async()
     except ValueError:
         pass
 
@@ -306,7 +433,7 @@ async def resetall(ctx):
     """Set the location of the map for the web view."""
     taskmap = maps[ctx.message.server.id]
     taskmap.reset_all()
-    taskmap.save()
+    await taskmap.save_async()
 
 
 @client.command(pass_context=True)
@@ -316,7 +443,26 @@ async def resetmap(ctx, server_id):
     if int(ctx.message.author.id) == int(maintainer_id):
         taskmap = maps[server_id]
         taskmap.reset_all()
-        taskmap.save()
+        await taskmap.save_async()
+    else:
+        await client.say("Sorry you can't do that" + ctx.message.author.id)
+
+
+@client.command(pass_context=True)
+@pass_errors
+async def stats(ctx, scope='all'):
+    """Allow bot owner to see the slowest parts of the bot, for every server or just this one with "here"."""
+    if int(ctx.message.author.id) == int(maintainer_id):
+        if scope == 'here' and ctx.message.server is not None:
+            lines = metrics.registry.summary(guild=ctx.message.server.id)
+        else:
+            lines = metrics.registry.summary()
+        summary = ''
+        for line in lines:
+            if len(summary) + len(line) > 1900:
+                break
+            summary += line + '\n'
+        await client.say('```' + (summary or 'Nothing timed yet\n') + '```')
     else:
         await client.say("Sorry you can't do that" + ctx.message.author.id)
 
@@ -328,7 +474,7 @@ async def resetallmaps(ctx):
     if int(ctx.message.author.id) == int(maintainer_id):
         for taskmap in maps.values():
             taskmap.reset_all()
-            taskmap.save()
+            await taskmap.save_async()
             await client.say("Reset map: " + taskmap._data['path'])
     else:
         await client.say("Sorry you can't do that" + ctx.message.author.id)
@@ -344,7 +490,7 @@ async def setbounds(ctx, lat1, long1, lat2, long2):
     coords2 = [float(lat2), float(long2)]
     taskmap.set_bounds(coords1, coords2)
     try:
-        taskmap.save()
+        await taskmap.save_async()
     except ValueError:
         pass
 
@@ -356,10 +502,35 @@ async def settimezone(ctx, tz_str):
     """Set the timezone of the map so it resets itself correctly."""
     taskmap = maps[ctx.message.server.id]
     taskmap.set_time_zone(tz_str)
+    schedule_rollover(ctx.message.server.id, taskmap)
+    try:
+        await taskmap.save_async()
+    except ValueError:
+        pass
+
+
+@client.command(pass_context=True)
+@has_permissions(administrator=True)
+@pass_errors
+async def reportchannel(ctx, setting='on'):
+    """Turn looking for reports in this channel on or off. Once any channel is on, reports are only looked for in those channels."""
+    taskmap = maps[ctx.message.server.id]
+    taskmap.set_report_channel(ctx.message.channel.id, setting.lower() != 'off')
     try:
-        taskmap.save()
+        await taskmap.save_async()
     except ValueError:
         pass
+    await client.add_reaction(ctx.message, '👍')
+
+
+@client.command()
+@pass_errors
+async def filterstats():
+    """Show how many messages each stage of the report filter has rejected."""
+    if not report_filter_counts:
+        await client.say('No messages checked yet')
+    else:
+        await client.say('\n'.join(stage + ': ' + str(count) for stage, count in report_filter_counts.most_common()))
 
 
 @client.command(pass_context=True)
@@ -368,8 +539,7 @@ async def want(ctx, *roles):
     """Set a given pokemon sighting role to a user."""
     all_pokemon = True
     bad = ''
-    for role in roles:
-        match = pokemap.match_pokemon(role)
+    for role, match in zip(roles, pokemap.match_many(roles)):
         if match is not None:
             user = ctx.message.author
             role_obj = discord.utils.get(ctx.message.server.roles, name=match.lower())
@@ -397,8 +567,7 @@ async def unwant(ctx, *roles):
             user = ctx.message.author
             roles = ctx.message.author.roles
             for role in roles:
-                match = pokemap.match_pokemon(role)
-                if match is not None:
+                if role.name in pokemap.pokemon_names():
                     await client.remove_roles(user, role)
             await client.add_reaction(ctx.message, '👍')
             return
@@ -426,13 +595,10 @@ async def listwants(ctx):
     str_num = 0
     embed_str.append('')
 
-    with open('pokemon.txt') as file:
-        line = file.readline()
-        while line:
-            for role in roles:
-                if role.name.title() in line:
-                    pokemon.append(role.name.title())
-            line = file.readline()
+    names = pokemap.pokemon_names()
+    for role in roles:
+        if role.name in names:
+            pokemon.append(role.name.title())
     if pokemon == []:
         await client.say('No want roles found.')
     else:
@@ -457,6 +623,12 @@ async def serverid(context):
 
 @client.event
 async def on_message(message):
+    """Respond to messages, timing how long each takes."""
+    with metrics.timer('bot_on_message_seconds', guild=message.server.id if message.server is not None else None):
+        await handle_message(message)
+
+
+async def handle_message(message):
     """Respond to messages.
 
     Contains the help commands, and the bots ability to parse language.
@@ -473,7 +645,7 @@ async def on_message(message):
         return
     elif message.content.startswith(bot_prefix):
         if message.server is not None:
-            prev_message_was_stop[message.server.id] = False
+            report_sessions.discard(session_key(message))
         msg = message.content.strip("".join(list(bot_prefix)))
         if msg.startswith('help'):
             if 'addstop' in message.content.lower():
@@ -527,6 +699,10 @@ async def on_message(message):
                 commands = {}
                 commands[bot_prefix[0] + 'deletetask'] = 'Remove a task from the list.'
                 commands[bot_prefix[0] + 'deletestop'] = 'Remove a stop from the local map.'
+                commands[bot_prefix[0] + 'near'] = 'List the stops within a radius (in meters, 50 by default) of a latitude and longitude.'
+                commands[bot_prefix[0] + 'importstops'] = 'Add all the stops in an attached CSV (name, lat, long), GeoJSON or Ingress portal export file (Requires admin).'
+                commands[bot_prefix[0] + 'reportchannel'] = 'Only look for reports in this channel and any others chosen this way, or use "off" to stop looking here (Requires admin).'
+                commands[bot_prefix[0] + 'filterstats'] = 'Show how many messages were ruled out as reports at each stage of the report filter.'
                 commands[bot_prefix[0] + 'resettasklist'] = 'Completely clear the tasklist. Use only if the tasklist has become corrupted,' +\
                     ' otherwise use the deletetask command to remove unwanted tasks one by one.'
                 commands[bot_prefix[0] + 'resetall'] = 'Reset all the stops in the map. Use when an event causes research changes (Requires admin).'
@@ -567,77 +743,90 @@ async def on_message(message):
             msg.add_field(name=command_name, value=command_help, inline=False)
             await client.send_message(message.channel, embed=msg)
         else:
-            await client.process_commands(message)
-    elif prev_message_was_stop[message.server.id] and prev_message[message.server.id].author == message.author:
-        prev_message_was_stop[message.server.id] = False
-        if 'shadow' in message.content.lower():
-            pokemon = message.content.split()[-1]
-            try:
-                if 'shadow' not in pokemon.lower():
-                    if 'gone' in message.content.lower():
-                        prev_message_stop[message.server.id].reset_shadow()
-                    else:
-                        prev_message_stop[message.server.id].set_shadow(pokemon)
-                else:
-                    prev_message_stop[message.server.id].set_shadow()
-                taskmap.save()
-                await client.add_reaction(prev_message[message.server.id], '👍')
-                await client.add_reaction(message, '👍')
-            except pokemap.PokemapException as e:
-                await client.send_message(message.channel, e.message)
+            with metrics.timer('bot_command_seconds', guild=message.server.id if message.server is not None else None, command=invoked_command_name(msg)):
+                await client.process_commands(message)
+    elif message.server is None:
+        report_filter_counts['direct_message'] += 1
+    elif session_key(message) in report_sessions:
+        session = report_sessions.pop(session_key(message))
+        try:
+            session.stop.report(message.content, tasklist)
+        except pokemap.PokemapException as e:
+            await client.send_message(message.channel, e.message)
         else:
-            try:
-                task_name = message.content
-                task = tasklist.find_task(task_name)
-                prev_message_stop[message.server.id].set_task(task)
-                if task_name.title() in task.rewards:
-                    prev_message_stop[message.server.id].properties['Icon'] = task_name.title()
-                taskmap.save()
-                await client.add_reaction(prev_message[message.server.id], '👍')
-                await client.add_reaction(message, '👍')
-            except pokemap.TaskAlreadyAssigned:
-                if prev_message_stop[message.server.id].properties['Reward'] == task.reward:
-                    await client.add_reaction(prev_message[message.server.id], '👍')
-                    await client.add_reaction(message, '👍')
-            except pokemap.PokemapException as e:
-                await client.send_message(message.channel, e.message)
+            schedule_shadow_expiry(message.server.id, taskmap)
+            taskmap.request_save()
+            await client.add_reaction(session.message, '👍')
+            await client.add_reaction(message, '👍')
     else:
+        stage = report_filter(message, taskmap)
+        report_filter_counts[stage] += 1
+        metrics.inc('bot_report_filter_total', guild=message.server.id, stage=stage)
+        if stage != 'passed':
+            return
         try:
             stop_name = message.content
-            prev_message_stop[message.server.id] = taskmap.find_stop(stop_name)
-            prev_message_was_stop[message.server.id] = True
-            prev_message[message.server.id] = message
+            report_sessions.start(session_key(message), taskmap.find_stop(stop_name), message)
         except pokemap.StopNotFound:
-            prev_message_was_stop[message.server.id] = False
             if '\n' in message.content:
-                try:
-                    args = message.content.split('\n', 1)
-                    stop_name = args[0]
-                    task_name = args[1]
-                    stop = taskmap.find_stop(stop_name)
-                    if 'shadow' in task_name.lower():
-                        pokemon = task_name.split()[-1]
-                        if 'shadow' not in pokemon:
-                            if 'gone' in message.content.lower():
-                                stop.reset_shadow()
-                            else:
-                                stop.set_shadow(pokemon)
-                        else:
-                            stop.set_shadow()
-                    else:
-                        task = tasklist.find_task(task_name)
-                        stop.set_task(task)
-                        if task_name.title() in task.rewards:
-                            stop.properties['Icon'] = task_name.title()
-                    taskmap.save()
-                    await client.add_reaction(message, '👍')
-                except pokemap.TaskAlreadyAssigned:
-                    if stop.properties['Reward'] == task.reward:
-                        await client.add_reaction(message, '👍')
-                    else:
-                        pass
-                except pokemap.PokemapException:
-                    pass
+                await apply_reports(message, taskmap)
+
+
+async def apply_reports(message, taskmap):
+    """Apply every report in a multi-line message, then save the map once.
+
+    A single report gets a thumbs up if it worked, while a list of reports gets one reply summing up what worked and what didn't.
+    Messages where no report worked are most likely chat, and are ignored.
+    """
+    results = taskmap.apply_reports(message.content, tasklist)
+    if not results:
+        return
+    failed = [(line, error) for line, stop, error in results if error is not None]
+    taskmap.request_save()
+    schedule_shadow_expiry(message.server.id, taskmap)
+    if len(results) == 1:
+        if not failed:
+            await client.add_reaction(message, '👍')
+        return
+    summary = 'Applied ' + str(len(results) - len(failed)) + ' of ' + str(len(results)) + ' reports.'
+    for line, error in failed:
+        to_add = '\n' + line + ': ' + error
+        if len(summary) + len(to_add) > 1900:
+            summary += '\n...'
+            break
+        summary += to_add
+    await client.send_message(message.channel, summary)
+
+
+def invoked_command_name(msg):
+    """Return the name of the command a message with its prefix removed is calling, or unknown for anything else."""
+    words = msg.split(None, 1)
+    if words and words[0] in client.commands:
+        return client.commands[words[0]].name
+    return 'unknown'
+
+
+def session_key(message):
+    """Return the key of the report session a message belongs to."""
+    return (message.server.id, message.channel.id, message.author.id)
+
+
+def report_filter(message, taskmap):
+    """Return the first stage of the report filter that rules a message out as a stop report, or 'passed'.
+
+    The stages go from cheapest to most expensive, so ordinary chat is dropped before any stop names are looked at.
+    """
+    if taskmap.report_channels and message.channel.id not in taskmap.report_channels:
+        return 'channel'
+    lines = message.content.count('\n') + 1
+    if not message.content.strip() or lines > max_report_lines or len(message.content) > max_report_length * lines:
+        return 'length'
+    stop_name = message.content.split('\n', 1)[0]
+    if len(stop_name.split()) > max_stop_words:
+        return 'words'
+    if not taskmap.could_be_stop(stop_name):
+        return 'stop_names'
+    return 'passed'
 
 
 async def list_servers():
@@ -650,23 +839,99 @@ async def list_servers():
         await asyncio.sleep(1800)
 
 
-async def check_maps():
-    """Map checks every few minutes."""
+def schedule_rollover(server_id, taskmap):
+    """Schedule a map's next midnight reset, offset by a fixed per server delay so the maps aren't all saved at once."""
+    rollovers.schedule(server_id, taskmap.next_rollover() + int(server_id) % rollover_spread)
+    timer_wakeup.set()
+
+
+def schedule_shadow_expiry(server_id, taskmap):
+    """Schedule a check for when the next rocket raid in a map ends."""
+    expiry = taskmap.next_shadow_expiry()
+    if expiry is None:
+        shadow_expiries.remove(server_id)
+    else:
+        shadow_expiries.schedule(server_id, expiry)
+        timer_wakeup.set()
+
+
+async def map_timers():
+    """Reset each map at its local midnight and clear rocket raids as they end, sleeping until the next one is due."""
+    await client.wait_until_ready()
+    while not client.is_closed:
+        timer_wakeup.clear()
+        for server_id in rollovers.pop_due():
+            taskmap = maps.get(server_id)
+            if taskmap is None:
+                continue
+            if taskmap.rollover():
+                await taskmap.save_async()
+                print('Reset map ' + server_id + ' at: ' + datetime.now().strftime("%Y.%m.%d.%H%M%S"))
+            schedule_rollover(server_id, taskmap)
+        for server_id in shadow_expiries.pop_due():
+            taskmap = maps.get(server_id)
+            if taskmap is None:
+                continue
+            if taskmap.expire_shadows():
+                taskmap.request_save()
+            schedule_shadow_expiry(server_id, taskmap)
+        deadlines = [deadline for deadline in (rollovers.next_deadline(), shadow_expiries.next_deadline()) if deadline is not None]
+        timeout = max(0, min(deadlines) - time.time()) if deadlines else None
+        try:
+            await asyncio.wait_for(timer_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def flush_maps():
+    """Save maps that have had unsaved changes for longer than the save delay."""
     await client.wait_until_ready()
     while not client.is_closed:
-        print('Checking maps at: ' + datetime.now().strftime("%Y.%m.%d.%H%M%S"))
-        for key in maps:
-            taskmap = maps[key]
-            reset_bool = taskmap.reset_old()
-            if reset_bool:
-                taskmap.save()
-                print('Reset map at: ' + datetime.now().strftime("%Y.%m.%d.%H%M%S"))
-        now = datetime.strftime(datetime.now(), '%M')
-        diff = (datetime.strptime('01', '%M') - datetime.strptime(now, '%M')).total_seconds() % 300  # want to reset every 5 min
-        if diff < 60:
-            diff += 300
-        await asyncio.sleep(diff)
+        for taskmap in list(maps.values()):
+            try:
+                await taskmap.flush_async(compact_interval if taskmap.persists_edits else save_delay, publish_delay=save_delay)
+            except ValueError:
+                pass
+        await asyncio.sleep(1)
+
+
+async def write_metrics():
+    """Write the metrics to metrics_path every metrics_interval seconds."""
+    await client.wait_until_ready()
+    while not client.is_closed:
+        try:
+            metrics.registry.write(metrics_path)
+        except OSError as e:
+            print('Unable to write metrics to ' + metrics_path + ': ' + str(e))
+        await asyncio.sleep(metrics_interval)
+
+
+def served_map(server_id):
+    """Return the map for a server if it has one, for the map server, which passes on any id it is asked for."""
+    if not server_id.isdigit():   # Server ids are snowflakes, anything else could name some other file in map_dir
+        return None
+    if server_id in maps or os.path.exists(map_dir + server_id + '.json'):
+        return maps[server_id]
+    return None
+
+
+def flush_all_maps():
+    """Save every map with unsaved changes, used on shutdown."""
+    for taskmap in maps.values():
+        try:
+            taskmap.flush()
+        except ValueError:
+            pass
+
 
 client.loop.create_task(list_servers())
-client.loop.create_task(check_maps())
-client.run(discord_token)
+client.loop.create_task(map_timers())
+client.loop.create_task(flush_maps())
+if metrics_path is not None:
+    client.loop.create_task(write_metrics())
+if web_port is not None:
+    client.loop.run_until_complete(mapserver.MapServer(served_map, web_host, web_port).start(client.loop))
+try:
+    client.run(discord_token)
+finally:
+    flush_all_maps()
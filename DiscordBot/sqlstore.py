@@ -0,0 +1,176 @@
+"""SQLite storage for research maps and the tasklist, in place of GeoJSON and pickle files."""
+import json
+import os
+import sqlite3
+import threading
+import time
+import pokemap
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS maps (map_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stops (map_id TEXT NOT NULL, name TEXT NOT NULL, long REAL NOT NULL, lat REAL NOT NULL,
+                                  task TEXT, category TEXT, shadow_time INTEGER,
+                                  properties TEXT NOT NULL, geometry TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS stops_key ON stops (map_id, name, long, lat);
+CREATE INDEX IF NOT EXISTS stops_location ON stops (map_id, lat, long);
+CREATE TABLE IF NOT EXISTS nicknames (map_id TEXT NOT NULL, nickname TEXT NOT NULL, name TEXT NOT NULL,
+                                      long REAL NOT NULL, lat REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS nicknames_name ON nicknames (map_id, nickname);
+CREATE INDEX IF NOT EXISTS nicknames_stop ON nicknames (map_id, name, long, lat);
+CREATE TABLE IF NOT EXISTS edits (map_id TEXT NOT NULL, version INTEGER NOT NULL, op TEXT NOT NULL, name TEXT NOT NULL,
+                                  long REAL NOT NULL, lat REAL NOT NULL, feature TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS edits_version ON edits (map_id, version);
+CREATE TABLE IF NOT EXISTS tasks (position INTEGER PRIMARY KEY, reward TEXT NOT NULL, quest TEXT NOT NULL,
+                                  data TEXT NOT NULL);
+"""
+
+
+class SqliteStorage():
+    """Keep maps and the tasklist in an SQLite database.
+
+    A map loaded from the storage writes each stop edit as a single row update as it is made, so saving the whole map
+    only needs to happen occasionally. Saving a map still exports its GeoJSON file for the web viewer.
+
+    Whole map saves are written from a snapshot on an executor thread, so edits can be recorded after the snapshot was
+    taken but before it is written. Each edit is also kept in the edits table with the map version it was made at, and
+    a save applies the edits newer than its snapshot again after rewriting the map, then forgets the older ones.
+    """
+
+    def __init__(self, path):
+        """Open the database at path, creating the tables if needed."""
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')   # In WAL mode commits then skip fsync, only a power cut can lose the latest
+            self._db.executescript(SCHEMA)
+            self._db.commit()
+
+    def close(self):
+        """Close the database."""
+        with self._lock:
+            self._db.close()
+
+    def load_map(self, key, filepath=None):
+        """Load a map from the database, copying it in from the GeoJSON file at filepath the first time."""
+        with self._lock:
+            row = self._db.execute('SELECT data FROM maps WHERE map_id = ?', (str(key),)).fetchone()
+            if row is not None:
+                features = self._db.execute('SELECT properties, geometry FROM stops WHERE map_id = ? ORDER BY rowid',
+                                            (str(key),)).fetchall()
+        if row is None:
+            if filepath is None or not os.path.exists(filepath):
+                raise FileNotFoundError('No map stored for ' + str(key))
+            taskmap = pokemap.load(filepath)
+            self.save_map(key, taskmap._data)
+        else:
+            data = json.loads(row[0])
+            data['features'] = [{'type': 'Feature', 'properties': json.loads(properties), 'geometry': json.loads(geometry)}
+                                for properties, geometry in features]
+            taskmap = pokemap.load(data=data)
+        with self._lock, self._db:   # The stops table already has every edit, and versions restart with the new map
+            self._db.execute('DELETE FROM edits WHERE map_id = ?', (str(key),))
+        taskmap.attach_storage(self, key)
+        return taskmap
+
+    def load_timed(self, key, filepath=None):
+        """Load a map and reset its old stops, returning the map, whether any stops were reset and the seconds it took."""
+        start = time.perf_counter()
+        taskmap = self.load_map(key, filepath)
+        stops_reset = taskmap.reset_old()
+        return taskmap, stops_reset, time.perf_counter() - start
+
+    def save_map(self, key, data, version=None):
+        """Replace everything stored for a map with its data, in one transaction.
+
+        If version is given, the data is a snapshot taken at that map version, and edits recorded after it are kept.
+        """
+        meta = {name: value for name, value in data.items() if name != 'features'}
+        stops = []
+        nicknames = []
+        for feature in data['features']:
+            stops.append(_stop_row(key, feature))
+            nicknames.extend(_nickname_rows(key, feature))
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO maps (map_id, data) VALUES (?, ?)', (str(key), json.dumps(meta)))
+            self._db.execute('DELETE FROM stops WHERE map_id = ?', (str(key),))
+            self._db.execute('DELETE FROM nicknames WHERE map_id = ?', (str(key),))
+            self._db.executemany('INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', stops)
+            self._db.executemany('INSERT INTO nicknames VALUES (?, ?, ?, ?, ?)', nicknames)
+            if version is None:
+                self._db.execute('DELETE FROM edits WHERE map_id = ?', (str(key),))
+            else:
+                self._db.execute('DELETE FROM edits WHERE map_id = ? AND version <= ?', (str(key), version))
+                edits = self._db.execute('SELECT op, name, long, lat, feature FROM edits WHERE map_id = ? ORDER BY version',
+                                         (str(key),)).fetchall()
+                for op, name, long, lat, feature in edits:
+                    self._apply(key, op, json.loads(feature), (str(key), name, long, lat))
+
+    def record(self, key, op, stop, version=None):
+        """Write a single stop edit, as passed on by ResearchMap._record.
+
+        This commits on the calling thread, which in the bot is the event loop. Each commit only updates a few rows
+        and, with synchronous=NORMAL in WAL mode, doesn't wait for the disk, so it is kept inline rather than moved to
+        an executor where edits could be written out of order. The edit is also kept with its map version, for
+        save_map to apply again if it writes a snapshot taken before the edit.
+        """
+        feature = {'properties': stop._data['properties'], 'geometry': stop._data['geometry']}
+        where = (str(key),) + stop.key()
+        with self._lock, self._db:
+            self._apply(key, op, feature, where)
+            if version is not None:
+                self._db.execute('INSERT INTO edits VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                 (str(key), version, op) + where[1:] + (json.dumps(feature),))
+
+    def _apply(self, key, op, feature, where):
+        """Write a stop edit to the stops and nicknames tables, in the caller's transaction."""
+        if op == 'add_stop':
+            self._db.execute('INSERT INTO stops VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', _stop_row(key, feature))
+            self._db.executemany('INSERT INTO nicknames VALUES (?, ?, ?, ?, ?)', _nickname_rows(key, feature))
+        elif op == 'remove_stop':
+            self._db.execute('DELETE FROM stops WHERE map_id = ? AND name = ? AND long = ? AND lat = ?', where)
+            self._db.execute('DELETE FROM nicknames WHERE map_id = ? AND name = ? AND long = ? AND lat = ?', where)
+        else:
+            row = _stop_row(key, feature)
+            self._db.execute('UPDATE stops SET task = ?, category = ?, shadow_time = ?, properties = ? '
+                             'WHERE map_id = ? AND name = ? AND long = ? AND lat = ?', row[4:8] + where)
+            if op == 'add_nickname':
+                self._db.execute('DELETE FROM nicknames WHERE map_id = ? AND name = ? AND long = ? AND lat = ?', where)
+                self._db.executemany('INSERT INTO nicknames VALUES (?, ?, ?, ?, ?)', _nickname_rows(key, feature))
+
+    def load_tasklist(self, filepath=None, legacy_path=None):
+        """Load the tasklist, copying it in from the tasklist file at filepath or the pickle at legacy_path the first time."""
+        with self._lock:
+            rows = self._db.execute('SELECT data FROM tasks ORDER BY position').fetchall()
+        if not rows and filepath is not None:
+            tasklist = pokemap.read_tasklist(filepath, legacy_path)
+            self.save_tasklist(tasklist)
+            return tasklist
+        tasklist = pokemap.Tasklist()
+        for row in rows:
+            tasklist.add_task(pokemap.Task.from_dict(json.loads(row[0])))
+        return tasklist
+
+    def save_tasklist(self, tasklist):
+        """Replace the stored tasklist, in one transaction."""
+        rows = [(position, task.reward, task.quest, json.dumps(task.to_dict())) for position, task in enumerate(tasklist.tasks)]
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM tasks')
+            self._db.executemany('INSERT INTO tasks VALUES (?, ?, ?, ?)', rows)
+
+
+def _stop_row(key, feature):
+    """Return the stops table row for a feature."""
+    properties = feature['properties']
+    long, lat = feature['geometry']['coordinates'][:2]
+    shadow_time = properties.get('Shadow Time')
+    return (str(key), properties['Stop Name'], long, lat, properties.get('Task'), properties.get('Category'),
+            shadow_time if isinstance(shadow_time, int) else None, json.dumps(properties), json.dumps(feature['geometry']))
+
+
+def _nickname_rows(key, feature):
+    """Return the nicknames table rows for a feature."""
+    properties = feature['properties']
+    long, lat = feature['geometry']['coordinates'][:2]
+    return [(str(key), pokemap._normalize_name(nickname), properties['Stop Name'], long, lat)
+            for nickname in properties.get('Nicknames', [])]
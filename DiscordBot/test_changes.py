@@ -0,0 +1,38 @@
+"""Check that bulk edits are passed on to clients as a single reload instead of a change for every stop."""
+import unittest
+import pokemap
+
+
+class BulkChangesTest(unittest.TestCase):
+    """Follow the changes to a small map through a reset."""
+
+    def setUp(self):
+        """Build a map with a few stops and a listener collecting its changes."""
+        self.taskmap = pokemap.new()
+        for i, name in enumerate(['Library', 'Town Hall', 'Memorial Fountain']):
+            self.taskmap._add_new_stop([-76.5 + i * 0.001, 42.4], name, 1)
+        self.task = pokemap.Task('Pikachu', 'Catch 10 Pokemon', False)
+        self.changes = []
+        self.taskmap.add_listener(self.changes.append)
+
+    def test_reset_all(self):
+        """Check a reset sends one reload, and clients from before it are told to fetch the whole map."""
+        self.taskmap.find_stop('Library').set_task(self.task)
+        before = self.taskmap.version
+        self.taskmap.reset_all()
+        self.assertEqual([change['op'] for change in self.changes], ['set_task', 'reload'])
+        self.assertIsNone(self.taskmap.changes_since(before))
+        reloaded = self.taskmap.version
+        self.taskmap.find_stop('Town Hall').set_task(self.task)
+        self.assertEqual([change['stop'][0] for change in self.taskmap.changes_since(reloaded)], ['Town Hall'])
+
+    def test_import_stops(self):
+        """Check an import sends one reload, and one that adds nothing sends none."""
+        self.taskmap.set_bounds([42.3, -76.6], [42.5, -76.3])
+        self.taskmap.import_stops([('Raid Sign', '42.41', '-76.41'), ('Old Bridge', '42.42', '-76.42')])
+        self.taskmap.import_stops([('Raid Sign', '42.41', '-76.41')])
+        self.assertEqual([change['op'] for change in self.changes], ['reload'])
+
+
+if __name__ == '__main__':
+    unittest.main()
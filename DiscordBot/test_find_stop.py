@@ -0,0 +1,100 @@
+"""Check that the shortlist used by find_stop gives the same results as scoring every stop."""
+import random
+import unittest
+from fuzzywuzzy import fuzz
+import pokemap
+
+WORDS = ['Old', 'North', 'Grand', 'Saint', 'Maple', 'Oak', 'Elm', 'Lake', 'Hill', 'Market', 'Union', 'Plaque', 'Bridge', 'Park',
+         'Library', 'Church', 'Mural', 'Statue', 'Gazebo', 'Fountain', 'Town Hall', 'Post Office', 'Bench', 'Sign', 'Hall']
+
+
+def full_scan(taskmap, stop_name):
+    """Find a stop by scoring every stop in the map, as find_stop did before it had a shortlist."""
+    best_ratio = 0
+    best_stop = None
+    for stop in taskmap:
+        ratio = fuzz.partial_ratio(stop.properties['Stop Name'].title(), stop_name.title())
+        if ratio > 80 and ratio > best_ratio:
+            best_ratio = ratio
+            best_stop = stop
+        elif ratio == 100:
+            return None
+    return best_stop
+
+
+def typo(name, rng):
+    """Return a name with a few letters dropped, swapped, replaced or added."""
+    for i in range(rng.randint(1, 3)):
+        i = rng.randrange(len(name))
+        edit = rng.randrange(4)
+        if edit == 0 and len(name) > 1:
+            name = name[:i] + name[i + 1:]
+        elif edit == 1 and i < len(name) - 1:
+            name = name[:i] + name[i + 1] + name[i] + name[i + 2:]
+        elif edit == 2:
+            name = name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz ') + name[i + 1:]
+        else:
+            name = name[:i] + rng.choice('abcdefghijklmnopqrstuvwxyz ') + name[i:]
+    return name
+
+
+class FindStopShortlistTest(unittest.TestCase):
+    """Compare find_stop against the full scan for misspelled names."""
+
+    def setUp(self):
+        """Build a map with short and long stop names."""
+        rng = random.Random(2)
+        self.taskmap = pokemap.new()
+        names = set(WORDS)
+        while len(names) < 300:
+            names.add(' '.join(rng.choice(WORDS) for i in range(rng.randint(1, 3))))
+        self.names = sorted(names) + ['Ab', 'Q']
+        for i, name in enumerate(self.names):
+            self.taskmap._add_new_stop([-76.5 + i * 0.001, 42.4], name, 1)
+
+    def assert_same(self, query):
+        """Check find_stop finds the same stop as the full scan for a query that isn't an exact name."""
+        expected = full_scan(self.taskmap, query)
+        try:
+            found = self.taskmap.find_stop(query)
+        except pokemap.StopNotFound:
+            found = None
+        self.assertIs(found, expected, query)
+
+    def test_reported_misspellings(self):
+        """Check misspellings of short names that an earlier shortlist dropped."""
+        for query in ['plague', 'Brizge', 'Plcque eall', 'Statu', 'Ab', 'Qx']:
+            self.assert_same(query)
+
+    def test_random_misspellings(self):
+        """Check random misspellings of every kind of name."""
+        rng = random.Random(5)
+        for i in range(2000):
+            query = typo(rng.choice(self.names), rng)
+            if query.strip() and pokemap._normalize_name(query) not in self.taskmap._name_index:
+                self.assert_same(query)
+
+
+class CouldBeStopTest(unittest.TestCase):
+    """Check the cheap check run on chat before find_stop."""
+
+    def setUp(self):
+        """Build a small map with a stop name shorter than 3 characters."""
+        self.taskmap = pokemap.new()
+        for i, name in enumerate(['Library', 'Town Hall', 'Memorial Fountain', 'Raid Sign', 'Ab']):
+            self.taskmap._add_new_stop([-76.5 + i * 0.001, 42.4], name, 1)
+
+    def test_chat_is_rejected(self):
+        """Check chat sharing only a few letters with stop names is turned away, even with a short stop name."""
+        for text in ['anyone going to the raid later?', 'lol', 'nice catch!', 'is the gym still blue', 'omw', 'thanks everyone',
+                     'about to head out', 'ok']:
+            self.assertFalse(self.taskmap.could_be_stop(text), text)
+
+    def test_names_are_accepted(self):
+        """Check names, short names and misspellings find_stop matches are let through."""
+        for text in ['Library', 'ab', 'Libary', 'town hal', 'Memorial Fontain', 'raid sing']:
+            self.assertTrue(self.taskmap.could_be_stop(text), text)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""Check that evicting maps from the cache saves them without blocking the event loop and tells the bot about it."""
+import asyncio
+import os
+import shutil
+import tempfile
+import unittest
+import pokemap
+
+
+class MapCacheEvictTest(unittest.TestCase):
+    """Evict maps from a cache that holds one map."""
+
+    def setUp(self):
+        """Make a cache of maps saved in a new directory."""
+        self.directory = tempfile.mkdtemp()
+        self.evicted = []
+        self.cache = pokemap.MapCache(self.load, max_maps=1, on_evict=lambda key, taskmap: self.evicted.append(key))
+
+    def tearDown(self):
+        """Delete the directory."""
+        shutil.rmtree(self.directory)
+
+    def load(self, key):
+        """Return a new map with one stop, saved as key.json."""
+        taskmap = pokemap.new()
+        taskmap._data['path'] = os.path.join(self.directory, key + '.json')
+        taskmap._add_new_stop([-76.5, 42.4], 'Library', 1)
+        taskmap.request_save()
+        return taskmap
+
+    def test_evict_in_background(self):
+        """Check an evicted map is saved after the event loop gets going again, and is put back if used before then."""
+        async def evict():
+            """Evict a map, use it again straight away, then evict it again and let the save finish."""
+            first = self.cache['1']
+            self.cache['2']
+            self.assertFalse(os.path.exists(os.path.join(self.directory, '1.json')))
+            self.assertIs(self.cache['1'], first)
+            self.cache['2']
+            for i in range(20):
+                await asyncio.sleep(0.01)
+        asyncio.get_event_loop().run_until_complete(evict())
+        self.assertEqual(self.evicted, ['1', '2', '1'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, '1.json')))
+        self.assertEqual(len(pokemap.load(os.path.join(self.directory, '1.json'))), 1)
+
+    def test_evict_without_loop(self):
+        """Check an evicted map is saved straight away when no event loop is running."""
+        self.cache['1']
+        self.cache['2']
+        self.assertEqual(self.evicted, ['1'])
+        self.assertTrue(os.path.exists(os.path.join(self.directory, '1.json')))
+
+
+class SessionStoreTest(unittest.TestCase):
+    """End the sessions of a guild."""
+
+    def test_discard_guild(self):
+        """Check only the sessions in the guild are ended."""
+        sessions = pokemap.SessionStore(60)
+        for key in [('1', 'a', 'x'), ('2', 'a', 'x'), ('1', 'b', 'y')]:
+            sessions.start(key, None, None)
+        sessions.discard_guild('1')
+        self.assertEqual([key in sessions for key in [('1', 'a', 'x'), ('2', 'a', 'x'), ('1', 'b', 'y')]], [False, True, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
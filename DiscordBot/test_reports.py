@@ -0,0 +1,46 @@
+"""Check that messages with many lines are only applied as reports when they are lists of reports."""
+import unittest
+import pokemap
+
+
+class ApplyReportsTest(unittest.TestCase):
+    """Apply messages to a small map."""
+
+    def setUp(self):
+        """Build a map with a few stops and a tasklist with a few tasks."""
+        self.taskmap = pokemap.new()
+        for i, name in enumerate(['Library', 'Town Hall', 'Memorial Fountain', 'Raid Sign']):
+            self.taskmap._add_new_stop([-76.5 + i * 0.001, 42.4], name, 1)
+        self.tasklist = pokemap.Tasklist()
+        for reward in ['Pikachu', 'Eevee', 'Rare Candy']:
+            self.tasklist.add_task(pokemap.Task(reward, 'Catch 10 Pokemon', False))
+
+    def tasks(self):
+        """Return the task of every stop."""
+        return [stop.properties['Task'] for stop in self.taskmap]
+
+    def test_chat_is_ignored(self):
+        """Check chat of two or more lines applies nothing and gets no results to reply with."""
+        for text in ['anyone going to the raid later?\nlol\nsee you there',
+                     'anyone going to the raid later?\nok',
+                     'anyone going to the raid later?\nyes, at the library\nme too, on my way',
+                     'good morning\nthe raid sign, anyone?']:
+            self.assertEqual(self.taskmap.apply_reports(text, self.tasklist), [], text)
+        self.assertEqual(self.tasks(), [''] * 4)
+
+    def test_two_lines(self):
+        """Check a stop followed by its task on the next line is applied."""
+        results = self.taskmap.apply_reports('Library\nPikachu', self.tasklist)
+        self.assertEqual([error for line, stop, error in results], [None])
+        self.assertEqual(self.taskmap.find_stop('Library').properties['Reward'], 'Pikachu')
+
+    def test_list(self):
+        """Check a list applies the lines that work, reports the ones that don't and skips lines without a separator."""
+        results = self.taskmap.apply_reports("Today's tasks\nLibrary, Pikachu\nTown Hall - Eevee\nLibrary, Mewtwo", self.tasklist)
+        self.assertEqual([line for line, stop, error in results], ['Library, Pikachu', 'Town Hall - Eevee', 'Library, Mewtwo'])
+        self.assertEqual([error is None for line, stop, error in results], [True, True, False])
+        self.assertEqual(self.taskmap.find_stop('Town Hall').properties['Reward'], 'Eevee')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+"""Check that saving a map to SQLite from a snapshot keeps the edits recorded after the snapshot was taken."""
+import os
+import shutil
+import tempfile
+import unittest
+import pokemap
+import sqlstore
+
+
+class SaveSnapshotTest(unittest.TestCase):
+    """Save a snapshot of a stored map after editing the map."""
+
+    def setUp(self):
+        """Store a map with a few stops in a new database."""
+        self.directory = tempfile.mkdtemp()
+        self.store = sqlstore.SqliteStorage(os.path.join(self.directory, 'maps.db'))
+        taskmap = pokemap.new()
+        for i, name in enumerate(['Library', 'Town Hall', 'Memorial Fountain']):
+            taskmap._add_new_stop([-76.5 + i * 0.001, 42.4], name, 1)
+        self.store.save_map('1', taskmap._data)
+        self.taskmap = self.store.load_map('1')
+
+    def tearDown(self):
+        """Close and delete the database."""
+        self.store.close()
+        shutil.rmtree(self.directory)
+
+    def reload(self):
+        """Return the map as it is stored now."""
+        return self.store.load_map('1')
+
+    def test_edit_after_snapshot(self):
+        """Check edits made between taking a snapshot and writing it survive the write."""
+        task = pokemap.Task('Pikachu', 'Catch 10 Pokemon', False)
+        self.taskmap.find_stop('Library').set_task(task)
+        snapshot, version = self.taskmap.snapshot(), self.taskmap._version
+        self.taskmap.find_stop('Town Hall').set_task(task)
+        self.taskmap.remove_stop(self.taskmap.find_stop('Memorial Fountain'))
+        self.taskmap._add_new_stop([-76.4, 42.4], 'Raid Sign', 1)
+        self.store.save_map('1', snapshot, version)
+        stored = self.reload()
+        self.assertEqual(sorted(stop.properties['Stop Name'] for stop in stored), ['Library', 'Raid Sign', 'Town Hall'])
+        self.assertEqual(stored.find_stop('Library').properties['Reward'], 'Pikachu')
+        self.assertEqual(stored.find_stop('Town Hall').properties['Reward'], 'Pikachu')
+
+    def test_edits_before_snapshot_are_forgotten(self):
+        """Check a save forgets the edits its snapshot already has, so a later save doesn't apply them again."""
+        self.taskmap._add_new_stop([-76.4, 42.4], 'Raid Sign', 1)
+        snapshot, version = self.taskmap.snapshot(), self.taskmap._version
+        self.store.save_map('1', snapshot, version)
+        self.store.save_map('1', snapshot, version)
+        self.assertEqual([stop.properties['Stop Name'] for stop in self.reload()].count('Raid Sign'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()